@@ -1,19 +1,61 @@
 import os
+import hashlib
+from contextlib import ExitStack
 import numpy as np
 import pandas as pd
 from osgeo import gdal
 from PyQt5.QtCore import QObject, pyqtSignal
 import shutil
+from .raster_io import (iter_blocks, iter_array_blocks, map_blocks, read_array, raster_info, WriteProfileMixin, RasterWriter, fix_ref_system,
+                        minimal_integer_type, driver_name, releases_datasets)
 
 # GDAL exceptions
 gdal.UseExceptions()
 
-class AllocationTool(QObject):
+# Tabulation bin ids are vulnerability class * BIN_ID_FACTOR + subdivision id, held as int32 in memory
+BIN_ID_FACTOR = 1000
+BIN_ID_DTYPE = np.int32
+# RST stores 32-bit integers as float32, which holds every integer up to 2**24 exactly
+RST_MAX_BIN_ID = 2 ** 24
+
+# Columns of the relative frequency table and their keys in the binary bin table next to the csv.
+# The bin ids are not remapped to dense indices, counts and lookup vectors are indexed by the raw bin ids,
+# so only these columns are stored next to the csv.
+RELATIVE_FREQUENCY_COLUMNS = (('ID', 'ID'),
+                              ('Total Deforestation(pixel)', 'total_deforestation'),
+                              ('Area of the Bin(pixel)', 'area'),
+                              ('Average Deforestation(pixel)', 'average_deforestation'))
+
+class PredictionRunSummary:
+    '''
+    Values of one CNF/VP prediction run, computed once and shared by the AR solver and the final map writer
+    '''
+    def __init__(self):
+        # Maximum density: areal resolution of the map pixels (ha)
+        self.maximum_density = None
+        # Actual Deforestation (AD) during the CNF (ha), None for the VP
+        self.actual_deforestation = None
+        # AD in the CNF or expected deforestation in the VP (ha)
+        self.target_deforestation = None
+        # Adjustment Ratio applied to the prediction densities
+        self.AR = None
+        # Modeled deforestation of the adjusted prediction density map (ha), None if the iterations did not finish
+        self.achieved_deforestation = None
+        # Number of iterations of the iterative AR solver
+        self.iterations = None
+
+class AllocationTool(QObject, WriteProfileMixin):
     progress_updated = pyqtSignal(int)
 
     def __init__(self):
         super(AllocationTool, self).__init__()
         self.data_folder = None
+        # Adjustment ratio solver of the prediction stage, 'exact' or 'iterative'
+        self.ar_solver = 'exact'
+        # PredictionRunSummary of the last prediction workflow
+        self.run_summary = None
+        # Number of threads of the block processing, all CPUs by default
+        self.workers = None
 
     def set_working_directory(self, directory):
         '''
@@ -23,14 +65,27 @@ class AllocationTool(QObject):
         self.data_folder = directory
         os.chdir(self.data_folder)
 
+    def set_ar_solver(self, solver):
+        '''
+        Set up the adjustment ratio solver of the prediction stage
+        :param solver: 'exact' (closed-form solution with the capped densities) or 'iterative' (fixed-point
+                       iteration limited by max_iterations)
+        '''
+        if solver not in ('exact', 'iterative'):
+            raise ValueError(f"Unknown adjustment ratio solver: {solver}")
+        self.ar_solver = solver
+
+    def set_workers(self, workers):
+        '''
+        Set up the number of threads used to process the raster blocks
+        :param workers: number of threads, None for all CPUs, 1 to process on the calling thread
+        '''
+        self.workers = workers
+
 ###Step1 Create the Fitting Modeling Region Map###
     def image_to_array(self,image):
-        # Set up a GDAL dataset
-        in_ds = gdal.Open(image)
-        # Set up a GDAL band
-        in_band = in_ds.GetRasterBand(1)
-        # Create Numpy Array1
-        arr = in_band.ReadAsArray()
+        # TerrSet binary rasters are memory-mapped, other formats are read through GDAL
+        arr = read_array(image)
         return arr
 
     def array_to_image(self, in_fn, out_fn, data, data_type, nodata=None):
@@ -43,75 +98,298 @@ class AllocationTool(QObject):
          :param nodata:optional NoData value
          :return:
         '''
-        in_ds = gdal.Open(in_fn)
-        output_format = out_fn.split('.')[-1].upper()
-        if (output_format == 'TIF'):
-            output_format = 'GTIFF'
-        elif (output_format == 'RST'):
-            output_format = 'rst'
-        driver = gdal.GetDriverByName(output_format)
-        out_ds = driver.Create(out_fn, in_ds.RasterXSize, in_ds.RasterYSize, 1, data_type, options=["BigTIFF=YES"])
-        out_band = out_ds.GetRasterBand(1)
-        out_ds.SetGeoTransform(in_ds.GetGeoTransform())
-        out_ds.SetProjection(in_ds.GetProjection().encode('utf-8', 'backslashreplace').decode('utf-8'))
-        if nodata is not None:
-            out_band.SetNoDataValue(nodata)
-        out_band.WriteArray(data)
-        out_band.FlushCache()
-        out_ds.FlushCache()
+        # Write the whole array as a single window
+        with RasterWriter(in_fn, out_fn, data_type, nodata, self.write_profile) as writer:
+            writer.write((0, 0, data.shape[1], data.shape[0]), data)
         return
 
-    def tabulation_bin_id_HRP(self, risk30_hrp, municipality, out_fn1):
+    def subdivision_range(self, risk_arr, municipality_arr):
+        '''
+        Largest vulnerability class and range of the subdivision ids over the pixels with a vulnerability class
+        The other pixels get the bin id 0 whatever their subdivision value (e.g. a NoData value)
+        :param risk_arr: vulnerability class array
+        :param municipality_arr: subdivision array
+        :return: (maximum class, minimum id, maximum id), None if no pixel has a vulnerability class
+        '''
+        risk_mask = risk_arr > 0
+        if not risk_mask.any():
+            return None
+        subdivision_ids = municipality_arr[risk_mask]
+        return int(risk_arr.max()), int(subdivision_ids.min()), int(subdivision_ids.max())
+
+    def plan_bin_id_type(self, risk_image, municipality, out_fn=None):
+        '''
+        Plan the data type of the tabulation bin id map (vulnerability class * 1000 + municipality)
+        The vulnerability class and subdivision ranges are collected block by block
+        :param risk_image: vulnerability class map
+        :param municipality: subdivision map
+        :param out_fn: tabulation bin id map to create, RST maps are checked against RST_MAX_BIN_ID
+        :return: (GDAL data type, NumPy dtype) of the smallest signed type that can not overflow
+        '''
+        value_range = None
+        for _, block_range in map_blocks(self.subdivision_range, iter_blocks(risk_image, municipality), self.workers):
+            if block_range is None:
+                continue
+            if value_range is None:
+                value_range = block_range
+            else:
+                value_range = (max(value_range[0], block_range[0]), min(value_range[1], block_range[1]),
+                               max(value_range[2], block_range[2]))
+        if value_range is None:
+            return minimal_integer_type(-1, 0)
+        max_risk, min_subdivision, max_subdivision = value_range
+        # Subdivision ids of 1000 or more would fall into the bins of the next vulnerability class
+        if min_subdivision < 0 or max_subdivision >= BIN_ID_FACTOR:
+            raise ValueError(f"The subdivision ids must be between 0 and {BIN_ID_FACTOR - 1}")
+        max_bin_id = max_risk * BIN_ID_FACTOR + max_subdivision
+        if max_bin_id > np.iinfo(BIN_ID_DTYPE).max:
+            raise ValueError("The vulnerability classes are too large for the tabulation bin ids")
+        if out_fn is not None and driver_name(out_fn) == 'rst' and max_bin_id > RST_MAX_BIN_ID:
+            raise ValueError(f"The tabulation bin ids up to {max_bin_id} can not be stored exactly in an RST map, "
+                             f"please save the modeling region map as a GeoTIFF (.tif)")
+        return minimal_integer_type(-1, max_bin_id)
+
+    def bin_table_path(self, csv):
+        '''
+        Path of the bin table stored next to the relative frequency table
+        :param csv: relative frequency table
+        :return: path of the .npz bin table
+        '''
+        return os.path.splitext(csv)[0] + '_bins.npz'
+
+    def csv_digest(self, csv):
+        '''
+        SHA-1 of the relative frequency table, used when the modification time alone does not match
+        :param csv: relative frequency table
+        :return: hex digest
+        '''
+        digest = hashlib.sha1()
+        with open(csv, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def save_bin_table(self, csv, table):
+        '''
+        Store the columns of the relative frequency table next to the csv, with the size, modification time and
+        SHA-1 of the csv it was written from.
+        :param csv: relative frequency table
+        :param table: relative frequency dataframe sorted by ID, as parsed from the csv
+        '''
+        # The columns keep the data types pandas parsed from the csv
+        columns = {key: table[column].to_numpy() for column, key in RELATIVE_FREQUENCY_COLUMNS}
+        stat = os.stat(csv)
+        np.savez(self.bin_table_path(csv), csv_size=stat.st_size, csv_mtime_ns=stat.st_mtime_ns,
+                 csv_sha1=self.csv_digest(csv), **columns)
+
+    def load_bin_table(self, csv):
+        '''
+        Load the bin table of the relative frequency table if it still matches the csv
+        :param csv: relative frequency table
+        :return: relative frequency dataframe, None if the bin table is missing, outdated or from an older version
+        '''
+        bin_table_path = self.bin_table_path(csv)
+        if not os.path.exists(bin_table_path):
+            return None
+        stat = os.stat(csv)
+        try:
+            with np.load(bin_table_path, allow_pickle=False) as bin_table:
+                if int(bin_table['csv_size']) != stat.st_size:
+                    return None
+                # A copied or touched csv keeps its content, compare the digest
+                if (int(bin_table['csv_mtime_ns']) != stat.st_mtime_ns and
+                        str(bin_table['csv_sha1']) != self.csv_digest(csv)):
+                    return None
+                return pd.DataFrame({column: bin_table[key] for column, key in RELATIVE_FREQUENCY_COLUMNS})
+        except (KeyError, ValueError, OSError):
+            return None
+
+    def read_relative_frequency_table(self, csv):
+        '''
+        Read the relative frequency table from its bin table, the csv is parsed only when the bin table does not
+        match it and the bin table is then rewritten if the folder of the csv is writable
+        :param csv: relative frequency table
+        :return: relative frequency dataframe
+        '''
+        table = self.load_bin_table(csv)
+        if table is None:
+            table = pd.read_csv(csv)
+            try:
+                self.save_bin_table(csv, table)
+            except OSError:
+                # Read-only folder or share: keep working from the csv
+                pass
+        return table
+
+    def bin_id_block(self, risk_block, municipality_block, bin_id_dtype=BIN_ID_DTYPE):
+        '''
+        Tabulation bin ids of one block, computed in BIN_ID_DTYPE and stored in bin_id_dtype
+        :param risk_block: vulnerability class block
+        :param municipality_block: subdivision block
+        :param bin_id_dtype: NumPy dtype of the bin ids, see plan_bin_id_type
+        :return: bin id block, 0 where the vulnerability class is 0
+        '''
+        # Create a mask where the vulnerability class larger than 1 reclassed into 1
+        mask_block = np.where(risk_block > 0, 1, risk_block)
+        bin_id_block = np.add(risk_block.astype(BIN_ID_DTYPE) * BIN_ID_FACTOR,
+                              municipality_block.astype(BIN_ID_DTYPE)) * mask_block
+        return bin_id_block.astype(bin_id_dtype, copy=False)
+
+    def write_bin_id_map(self, risk_image, municipality, out_fn1, deforestation=None):
+        '''
+        Write the tabulation bin id map (vulnerability class * 1000 + municipality) block by block,
+        row strips are processed in parallel and only a few strips are held in memory.
+        The bins are counted in the same pass, so the map does not have to be read back for the tabulation.
+        :param risk_image: vulnerability class map
+        :param municipality: subdivision map
+        :param out_fn1: tabulation bin id map to create, its RST reference system name is taken from municipality
+        :param deforestation: deforestation binary map to count within the bins, optional
+        :return: area_counts, deforestation_counts: np.bincount arrays indexed by bin id,
+                 deforestation_counts is None without a deforestation map
+        '''
+        # The map is written in the smallest signed integer data type holding the largest bin id and the NoData value -1
+        bin_id_data_type, bin_id_dtype = self.plan_bin_id_type(risk_image, municipality, out_fn1)
+        images = [risk_image, municipality] + ([deforestation] if deforestation is not None else [])
+
+        def block_function(risk_block, municipality_block, *deforestation_block):
+            bin_id_block = self.bin_id_block(risk_block, municipality_block, bin_id_dtype)
+            return bin_id_block, self.bin_counts_block(bin_id_block, *deforestation_block)
+
+        area_counts = np.zeros(1, dtype=np.int64)
+        deforestation_counts = np.zeros(1, dtype=np.int64)
+        # The strips are written by a background thread while the next ones are computed
+        with RasterWriter(risk_image, out_fn1, bin_id_data_type, -1, self.write_profile, municipality,
+                          background=True) as writer:
+            for window, (bin_id_block, block_counts) in map_blocks(block_function, iter_blocks(*images), self.workers):
+                writer.write(window, bin_id_block)
+                area_counts = self.add_counts(area_counts, block_counts[0])
+                if deforestation is not None:
+                    deforestation_counts = self.add_counts(deforestation_counts, block_counts[1])
+        if deforestation is None:
+            return area_counts, None
+        # Same length for both counts
+        return area_counts, self.add_counts(np.zeros(area_counts.size, dtype=np.int64), deforestation_counts)
+
+    def iter_bin_id_blocks(self, tabulation_bin_id_masked):
+        '''
+        Row strips of a tabulation bin id map or array
+        Blocks read from a map are cast to BIN_ID_DTYPE, RST maps return 32-bit ids as float32
+        :param tabulation_bin_id_masked: tabulation bin id map (path) or array
+        :return: generator of (window, [bin id block])
+        '''
+        if isinstance(tabulation_bin_id_masked, str):
+            return ((window, [bin_id_block.astype(BIN_ID_DTYPE, copy=False)])
+                    for window, (bin_id_block,) in iter_blocks(tabulation_bin_id_masked))
+        return iter_array_blocks(tabulation_bin_id_masked)
+
+    def density_lookup_table(self, bin_ids, bin_frequencies, areal_resolution_of_map_pixels, max_bin_id=0):
+        '''
+        Dense lookup vector from the tabulation bin ids to the densities
+        :param bin_ids: bin ids of the relative frequency table
+        :param bin_frequencies: float32 relative frequency of each bin
+        :param areal_resolution_of_map_pixels: pixel area (ha)
+        :param max_bin_id: largest bin id to look up
+        :return: float32 array, lut[bin_id] is the density of the bin, 0 for ids absent from the table
+        '''
+        bin_ids = np.asarray(bin_ids, dtype=np.int64)
+        size = int(max(bin_ids.max() if bin_ids.size else 0, max_bin_id)) + 1
+        density_lut = np.zeros(size, dtype=np.float32)
+        # Relative_frequency multiplied by the areal resolution of the map pixels to express the probabilities as densities
+        density_lut[bin_ids] = bin_frequencies * areal_resolution_of_map_pixels
+        return density_lut
+
+    def tabulation_bin_id_HRP(self, risk30_hrp, municipality, out_fn1, deforestation_hrp):
         """
-        This function is to create fitting modeling region array(tabulation_bin_id_masked)
-        and fitting modeling region map(tabulation_bin_image)
+        This function is to create fitting modeling region map(tabulation_bin_image)
+        The map is written block by block and the bins are counted while it is written.
+        The RST reference system name is taken from the subdivision image.
         :param risk30_hrp: The 30-class vulnerability map for the CAL/HRP
         :param municipality: Subdivision image
         :param out_fn1: user input
-        :return: tabulation_bin_id_masked: tabulation bin id array in CAL/HRP
+        :param deforestation_hrp: Deforestation Map during the CAL/HRP
+        :return: area_counts, deforestation_counts: pixel and deforestation counts of each bin id
         """
-        # Convert risk30_hrp to NumPy array
-        arr1 = self.image_to_array(risk30_hrp)
-
-        # Convert municipality to NumPy array2
-        arr2 = self.image_to_array(municipality)
-
-        # Create a mask where the risk30_hrp value larger than 1 reclassed into 1
-        mask_arr_HRP = np.where(arr1 > 0,1, arr1)
+        return self.write_bin_id_map(risk30_hrp, municipality, out_fn1, deforestation_hrp)
 
-        # Calculate tabulation bin id with mask
-        tabulation_bin_id_masked = np.add(arr1*1000, arr2) * mask_arr_HRP
+###Step2 Calculate the Relative Frequencies###
+    def add_counts(self, total_counts, counts):
+        '''
+        Add two np.bincount results of different lengths
+        :param total_counts: accumulated counts
+        :param counts: counts to add
+        :return: total_counts + counts, as long as the longer of the two
+        '''
+        if counts.size > total_counts.size:
+            total_counts, counts = counts, total_counts
+        total_counts[:counts.size] += counts
+        return total_counts
 
-        # Convert the array to signed 16-bit integer (int16) data type
-        tabulation_bin_id_masked = tabulation_bin_id_masked.astype(np.int16)
+    def bin_counts_block(self, bin_id_block, deforestation_block=None):
+        '''
+        Count the pixels and the deforestation pixels of each bin in one block
+        :param bin_id_block: tabulation bin id block (non-negative ids, 0 outside the bins)
+        :param deforestation_block: deforestation binary block, optional
+        :return: area_counts, deforestation_counts: np.bincount arrays, deforestation_counts is None without deforestation
+        '''
+        area_counts = np.bincount(bin_id_block.ravel())
+        if deforestation_block is None:
+            return area_counts, None
+        return area_counts, np.bincount(bin_id_block[deforestation_block != 0])
 
-        # Create the final image using tabulation_bin_image function
-        self.array_to_image(risk30_hrp, out_fn1, tabulation_bin_id_masked,
-                                     gdal.GDT_Int16, -1)
-        return tabulation_bin_id_masked
+    def tabulate_bin_counts(self, tabulation_bin_id_masked, deforestation):
+        '''
+        Count the pixels and the deforestation pixels of each bin block by block
+        :param tabulation_bin_id_masked: tabulation bin id array or map (non-negative ids, 0 outside the bins)
+        :param deforestation: deforestation binary map
+        :return: area_counts, deforestation_counts: np.bincount arrays indexed by bin id
+        '''
+        if isinstance(tabulation_bin_id_masked, str):
+            # RST maps return 32-bit ids as float32
+            blocks = ((window, [bin_id_block.astype(BIN_ID_DTYPE, copy=False), deforestation_block])
+                      for window, (bin_id_block, deforestation_block) in iter_blocks(tabulation_bin_id_masked,
+                                                                                     deforestation))
+        else:
+            blocks = ((window, [tabulation_bin_id_masked[window[1]:window[1] + window[3], window[0]:window[0] + window[2]],
+                                deforestation_block])
+                      for window, (deforestation_block,) in iter_blocks(deforestation))
+
+        area_counts = np.zeros(1, dtype=np.int64)
+        deforestation_counts = np.zeros(1, dtype=np.int64)
+        block_counts = map_blocks(self.bin_counts_block, blocks, self.workers)
+        for _, (block_area_counts, block_deforestation_counts) in block_counts:
+            area_counts = self.add_counts(area_counts, block_area_counts)
+            deforestation_counts = self.add_counts(deforestation_counts, block_deforestation_counts)
+        # Same length for both counts
+        deforestation_counts = self.add_counts(np.zeros(area_counts.size, dtype=np.int64), deforestation_counts)
+        return area_counts, deforestation_counts
 
-###Step2 Calculate the Relative Frequencies###
     def create_relative_frequency_table(self, tabulation_bin_id_masked, deforestation_hrp, csv_name):
         """
         Create dataframe
-        :param tabulation_bin_id_masked: array with id and total deforestation
+        :param tabulation_bin_id_masked: tabulation bin id array or map
         :param deforestation_hrp: Deforestation Map during the CAL/HRP
         :return: merged_df: relative frequency dataframe
         """
-        # Calculate array area of the bin [integer] (in pixels) for Col3 using np.unique and counts function, excluding 0
-        unique, counts = np.unique(tabulation_bin_id_masked[tabulation_bin_id_masked != 0], return_counts=True)
-        # Convert to array
-        arr_counts = np.asarray((unique, counts)).T
+        # Count the area of the bin [integer] (in pixels) for Col3 and the total deforestation within the bin [integer]
+        # for Col2 block by block with np.bincount over the bin ids, excluding 0
+        area_counts, deforestation_counts = self.tabulate_bin_counts(tabulation_bin_id_masked, deforestation_hrp)
+        return self.relative_frequency_table(area_counts, deforestation_counts, csv_name)
 
-        # Calculate total deforestation within the bin [integer] array for Col2
-        arr3 = self.image_to_array(deforestation_hrp)
+    def relative_frequency_table(self, area_counts, deforestation_counts, csv_name):
+        """
+        Create dataframe from the bin counts and save it as csv
+        :param area_counts: pixel counts of each bin id (np.bincount array)
+        :param deforestation_counts: deforestation counts of each bin id, same length as area_counts
+        :param csv_name: relative frequency table to create
+        :return: merged_df: relative frequency dataframe
+        """
+        unique = np.flatnonzero(area_counts[1:]) + 1
+        # Convert to array
+        arr_counts = np.asarray((unique, area_counts[unique])).T
 
-        # deforestation_within_bin will have tabulation_bin_id value in deforestation pixel
-        deforestation_within_bin = tabulation_bin_id_masked * arr3
-        # Use np.unique to counts total deforestation in each bin
-        unique1, counts1 = np.unique(deforestation_within_bin[deforestation_within_bin != 0], return_counts=True)
+        unique1 = np.flatnonzero(deforestation_counts[1:]) + 1
         # Convert to array
-        arr_counts_deforestion = np.asarray((unique1, counts1)).T
+        arr_counts_deforestion = np.asarray((unique1, deforestation_counts[unique1])).T
 
         # Create pandas DataFrames
         df1 = pd.DataFrame(arr_counts_deforestion, columns=['ID', 'Total Deforestation(pixel)'])
@@ -131,16 +409,19 @@ class AllocationTool(QObject):
 
         csv_file_path = csv_name
         merged_df.to_csv(csv_file_path, index=False)
+        # Store the bin table with the values as parsed from the csv
+        self.read_relative_frequency_table(csv_file_path)
 
         return merged_df
 
 ###Step 3 Fitting Phase: create the fitted density map###
-    def create_fit_density_map(self,risk30_hrp, tabulation_bin_id_masked, merged_df, out_fn2):
+    def create_fit_density_map(self,risk30_hrp, tabulation_bin_id_masked, merged_df, out_fn2, ref_fn=None):
         '''
         Create the fitting density map, this function used for fitting phase (CAL and HRP)
         :param risk30_hrp: the 30-class vulnerability map for the CAL/HRP
-        :param tabulation_bin_id_masked: array for tabulation bin id in fitting Phase
+        :param tabulation_bin_id_masked: tabulation bin id map or array in fitting Phase
         :param merged_df: relative frequency dataframe
+        :param ref_fn: datasource to copy the RST reference system name from, risk30_hrp by default
         :return:
         '''
         # Insert index=0 row into first row of merged_df DataFrame
@@ -148,211 +429,284 @@ class AllocationTool(QObject):
                                 'Average Deforestation(pixel)': [0]})
         merged_df = pd.concat([new_row, merged_df]).reset_index(drop=True)
 
-        # Using numpy.searchsorted() to assign values to 'id'
+        # Look up the density of each bin id
         df_sorted = merged_df.sort_values('ID')
-        sorted_indices = df_sorted['ID'].searchsorted(tabulation_bin_id_masked)
-        relative_frequency_arr = tabulation_bin_id_masked[:] = df_sorted['Average Deforestation(pixel)'].values[sorted_indices]
 
         # Calculate areal_resolution_of_map_pixels
-        in_ds4 = gdal.Open(risk30_hrp)
-        P1 = in_ds4.GetGeoTransform()[1]
-        P2 = abs(in_ds4.GetGeoTransform()[5])
-        areal_resolution_of_map_pixels = P1 * P2 / 10000
+        areal_resolution_of_map_pixels = self.calculate_maximum_density(risk30_hrp)
 
-        # Relative_frequency multiplied by the areal resolution of the map pixels to express the probabilities as densities
-        fit_density_arr=relative_frequency_arr * areal_resolution_of_map_pixels
+        # The table holds every bin id of the map it was tabulated from
+        density_lut = self.density_lookup_table(df_sorted['ID'].values,
+                                                df_sorted['Average Deforestation(pixel)'].values.astype(np.float32),
+                                                areal_resolution_of_map_pixels)
 
-        # Create the final fit_density_map image using tabulation_bin_image function
-        self.array_to_image(risk30_hrp, out_fn2, fit_density_arr, gdal.GDT_Float32, -1)
+        # Create the final fit_density_map image block by block
+        self.write_density_maps(tabulation_bin_id_masked, risk30_hrp, [(density_lut, out_fn2)], ref_fn)
 
         return
 
 ###Step 3 Prediction Phase: create the adjusted predicted density map###
     def tabulation_bin_id_VP (self, risk30_vp, municipality, out_fn1):
         """
-        This function is to create modeling region array(tabulation_bin_id_VP_masked)
-        and modeling region map(tabulation_bin_image_vp)
+        This function is to create modeling region map(tabulation_bin_image_vp)
+        The map is written block by block, later stages read it back block by block.
+        The RST reference system name is taken from the subdivision image.
         :param risk30_vp: The 30-class vulnerability map for the CNF/VP
         :param municipality: Subdivision image
         :param out_fn1: user input
-        :return: tabulation_bin_id_VP_masked: tabulation bin id array in CNF/VP
+        :return: out_fn1: tabulation bin id map in CNF/VP
         """
+        self.write_bin_id_map(risk30_vp, municipality, out_fn1)
+        return out_fn1
 
-        # Convert municipality and risk30_vp to NumPy array
-        arr2 = self.image_to_array(municipality)
-        arr4 = self.image_to_array(risk30_vp)
-
-        # Create a mask where the risk30_hrp value larger than 1 reclassed into 1
-        mask_arr_VP = np.where(arr4 > 0, 1, arr4)
-
-        # Calculate tabulation bin id of CNF/VP with mask
-        tabulation_bin_id_VP_masked = np.add(arr4 * 1000, arr2) * mask_arr_VP
-
-        # Convert the array to signed 16-bit integer (int16) data type
-        tabulation_bin_id_VP_masked = tabulation_bin_id_VP_masked.astype(np.int16)
-        #Write image to disk
-        self.array_to_image(risk30_vp, out_fn1, tabulation_bin_id_VP_masked,
-                                     gdal.GDT_Int16, -1)
-
-        return tabulation_bin_id_VP_masked
-
-
-    def calculate_prediction_density_arr(self,risk30_vp, tabulation_bin_id_VP_masked, csv):
+    def prediction_density_lut(self, risk30_vp, csv, max_bin_id=0):
         '''
-        Calculate the prediction density arry
-        :param tabulation_bin_id_VP_masked: array for tabulation bin id in CNF/VP
-        :param csv: relative frequency table
+        Dense lookup vector from the tabulation bin ids of the CNF/VP to the densities of the relative frequency table
         :param risk30_vp: the 30-class vulnerability map for the CNF/VP
-        :return: prediction_density_arr: modeled deforestation (MD)
+        :param csv: relative frequency table
+        :param max_bin_id: largest bin id to look up
+        :return: density_lut: float32 array indexed by bin id
         '''
-        # Read Relative Frequency csv file
-        merged_df=pd.read_csv(csv)
+        # Read Relative Frequency table
+        merged_df=self.read_relative_frequency_table(csv)
 
         # Insert index=0 row into first row of merged_df DataFrame
         new_row = pd.DataFrame({'ID': [0], 'Total Deforestation(pixel)': [0], 'Area of the Bin(pixel)': [0],
                                 'Average Deforestation(pixel)': [0]})
         merged_df = pd.concat([new_row, merged_df]).reset_index(drop=True)
 
-        # Using numpy.searchsorted() to assign values to 'id'
+        # Look up the density of each bin id
         df_sorted = merged_df.sort_values('ID')
-        sorted_indices = df_sorted['ID'].searchsorted(tabulation_bin_id_VP_masked)
-        relative_frequency_arr = tabulation_bin_id_VP_masked[:] = df_sorted['Average Deforestation(pixel)'].values[sorted_indices]
 
         # Calculate areal_resolution_of_map_pixels
-        in_ds4 = gdal.Open(risk30_vp)
-        P1 = in_ds4.GetGeoTransform()[1]
-        P2 = abs(in_ds4.GetGeoTransform()[5])
-        areal_resolution_of_map_pixels = P1 * P2 / 10000
-
-        # Relative_frequency multiplied by the areal resolution of the map pixels to express the probabilities as densities
-        prediction_density_arr=relative_frequency_arr * areal_resolution_of_map_pixels
+        areal_resolution_of_map_pixels = self.calculate_maximum_density(risk30_vp)
 
-        return prediction_density_arr
+        return self.density_lookup_table(df_sorted['ID'].values,
+                                         df_sorted['Average Deforestation(pixel)'].values.astype(np.float32),
+                                         areal_resolution_of_map_pixels, max_bin_id)
 
-    def calculate_adjustment_ratio_cnf(self, prediction_density_arr, deforestation_cnf):
+    def calculate_prediction_density_table(self, risk30_vp, tabulation_bin_id_VP_masked, csv):
         '''
-        Calculate the Adjustment Ratio (AR) in CNF
-        :param prediction_density_arr: modeled deforestation (MD)
-        :param deforestation_cnf: deforestation binary map in cnf
-        :return: AR
+        Calculate the prediction density of each modeling region bin of the CNF/VP
+        The density map takes one value per bin, the AR iteration runs on this table instead of the map
+        :param risk30_vp: the 30-class vulnerability map for the CNF/VP
+        :param tabulation_bin_id_VP_masked: tabulation bin id map or array in CNF/VP
+        :param csv: relative frequency table
+        :return: bin_ids: bin ids present in the map (including 0), bin_densities: float32 density of each bin,
+                 pixel_counts: number of pixels of each bin
         '''
+        pixel_counts = np.zeros(1, dtype=np.int64)
+        block_counts = map_blocks(lambda bin_id_block: np.bincount(bin_id_block.ravel()),
+                                  self.iter_bin_id_blocks(tabulation_bin_id_VP_masked), self.workers)
+        for _, counts in block_counts:
+            pixel_counts = self.add_counts(pixel_counts, counts)
+        bin_ids = np.flatnonzero(pixel_counts)
 
-        # Sum up the pixels in the prediction density map. This is the modeled deforestation (MD).
-        MD = np.sum(prediction_density_arr)
+        density_lut = self.prediction_density_lut(risk30_vp, csv, pixel_counts.size - 1)
+        return bin_ids, density_lut[bin_ids], pixel_counts[bin_ids]
 
-        # Calculate areal_resolution_of_map_pixels
-        in_ds5 = gdal.Open(deforestation_cnf)
-        P1 = in_ds5.GetGeoTransform()[1]
-        P2 = abs(in_ds5.GetGeoTransform()[5])
-        areal_resolution_of_map_pixels = P1 * P2 / 10000
+    def modeled_deforestation(self, prediction_density_arr, pixel_counts=None):
+        '''
+        Sum up the pixels in the prediction density map. This is the modeled deforestation (MD).
+        :param prediction_density_arr: prediction density map, or density of each bin
+        :param pixel_counts: number of pixels of each bin, None for a map
+        :return: MD
+        '''
+        if pixel_counts is None:
+            return np.sum(prediction_density_arr, dtype=np.float64)
+        return np.dot(prediction_density_arr.astype(np.float64), pixel_counts)
 
-        # Convert deforestation_cnf to array in ha
-        arr5 = self.image_to_array(deforestation_cnf)
-        arr5_ha=arr5 * areal_resolution_of_map_pixels
+    def calculate_maximum_density(self, image):
+        '''
+        Maximum density: areal resolution of the map pixels
+        :param image: map to take the pixel size from
+        :return: maximum_density (ha)
+        '''
+        geotransform = raster_info(image).geotransform
+        P1 = geotransform[1]
+        P2 = abs(geotransform[5])
+        return P1 * P2 / 10000
 
-        # Calculate the Actual Deforestation (AD) during the confirmation period
-        AD = np.sum(arr5_ha)
+    def calculate_actual_deforestation(self, deforestation_cnf):
+        '''
+        Calculate the Actual Deforestation (AD) during the confirmation period
+        :param deforestation_cnf: deforestation binary map in cnf
+        :return: AD (ha)
+        '''
+        # Calculate areal_resolution_of_map_pixels
+        areal_resolution_of_map_pixels = self.calculate_maximum_density(deforestation_cnf)
 
-        # AR = AD / MD
-        AR = AD / MD
-        return AR
+        # Count the deforestation pixels block by block and convert to ha
+        deforestation_pixels = 0
+        for _, (arr5,) in iter_blocks(deforestation_cnf):
+            deforestation_pixels += np.sum(arr5, dtype=np.float64)
+        AD = deforestation_pixels * areal_resolution_of_map_pixels
+        return AD
 
-    def calculate_adjustment_ratio(self,prediction_density_arr, expected_deforestation):
+    def calculate_adjustment_ratio(self,prediction_density_arr, expected_deforestation, pixel_counts=None):
         '''
         Calculate the Adjustment Ratio (AR) in VP
         :param prediction_density_arr: modeled deforestation (MD)
         :param expected_deforestation: user input
+        :param pixel_counts: number of pixels of each bin when prediction_density_arr holds bin densities
         :return: AR
         '''
 
         # Sum up the pixels in the prediction density map. This is the modeled deforestation (MD).
-        MD = np.sum(prediction_density_arr)
+        MD = self.modeled_deforestation(prediction_density_arr, pixel_counts)
 
         # AR = ED / MD
         AR = expected_deforestation / MD
         return AR
 
-    def adjusted_prediction_density_array (self, prediction_density_arr, risk30_vp, AR):
+    def solve_adjustment_ratio(self, bin_densities, pixel_counts, maximum_density, target_deforestation):
         '''
-        Create adjusted prediction density array
-        :param prediction_density_arr:modeled deforestation (MD)
-        :param risk30_vp: risk30_vp image
-        :param AR:Adjustment Ratio
-        :return: adjusted_prediction_density_np_arr
+        Exact Adjustment Ratio (AR) with the densities capped at the maximum density
+        The modeled deforestation sum(pixel_counts * min(AR * bin_densities, maximum_density)) increases with AR,
+        the bins are sorted by density to find how many of them are capped at the solution, and the other bins
+        are scaled to reach the target.
+        :param bin_densities: prediction density of each bin
+        :param pixel_counts: number of pixels of each bin
+        :param maximum_density: areal resolution of the map pixels (ha)
+        :param target_deforestation: Actual Deforestation (CNF) or expected deforestation (VP) in ha
+        :return: AR, achieved_deforestation: modeled deforestation of the adjusted densities (ha)
         '''
+        # Bins with a positive density, sorted by decreasing density
+        positive = bin_densities > 0
+        order = np.argsort(-bin_densities[positive], kind='stable')
+        densities = bin_densities[positive].astype(np.float64)[order]
+        counts = pixel_counts[positive].astype(np.float64)[order]
+        if densities.size == 0:
+            return 1.0, 0.0
+
+        # With the first k bins capped: capped_mass[k] from the capped bins, free_mass[k] = sum of the other bins
+        capped_mass = maximum_density * np.concatenate(([0.0], np.cumsum(counts)))
+        free_mass = np.concatenate((np.cumsum((counts * densities)[::-1])[::-1], [0.0]))
+
+        # Modeled deforestation when bin k reaches the maximum density (AR = maximum_density / densities[k])
+        break_mass = capped_mass[1:] + maximum_density / densities * free_mass[1:]
+        k = int(np.searchsorted(break_mass, target_deforestation))
+        if k == densities.size:
+            # The target can not be reached, all the forest is at the maximum density
+            AR = maximum_density / densities[-1]
+        else:
+            AR = (target_deforestation - capped_mass[k]) / free_mass[k]
 
-        # Calculate the maximum density
-        # Calculate areal_resolution_of_map_pixels
-        in_ds4 = gdal.Open(risk30_vp)
-        P1 = in_ds4.GetGeoTransform()[1]
-        P2 = abs(in_ds4.GetGeoTransform()[5])
-        maximum_density = P1 * P2 / 10000
+        adjusted_bin_densities = self.cap_adjusted_density(bin_densities, AR, maximum_density)
+        achieved_deforestation = self.modeled_deforestation(adjusted_bin_densities, pixel_counts)
+        return AR, achieved_deforestation
 
+    def cap_adjusted_density(self, prediction_density_arr, AR, maximum_density):
+        '''
+        Adjusted prediction density capped at the maximum density
+        :param prediction_density_arr: prediction density map, or density of each bin
+        :param AR: Adjustment Ratio
+        :param maximum_density: areal resolution of the map pixels (ha)
+        :return: adjusted_prediction_density_arr
+        '''
         # Adjusted_Prediction_Density_Map = AR x Prediction_Density _Map
-        adjusted_prediction_density_arr=AR*prediction_density_arr
+        adjusted_prediction_density_arr=float(AR)*prediction_density_arr
 
         # Reclassify all pixels greater than the maximum (e.g., 0.09) to be the maximum
         adjusted_prediction_density_arr[adjusted_prediction_density_arr > maximum_density] = maximum_density
 
         return adjusted_prediction_density_arr
 
-
-    def adjusted_prediction_density_map (self, prediction_density_arr, risk30_vp, AR, out_fn2):
+    def allocate_bin_densities(self, summary, bin_densities, pixel_counts, max_iterations):
         '''
-        Create adjusted prediction density map
-        :param prediction_density_arr:modeled deforestation (MD)
-        :param risk30_vp: risk30_vp image
-        :param AR:Adjustment Ratio
-        :param out_fn2: user input
-        :return:
+        Solve the Adjustment Ratio (AR) of the prediction stage on the bin table
+        :param summary: PredictionRunSummary with maximum_density and target_deforestation, AR,
+                        achieved_deforestation and iterations are filled in
+        :param bin_densities: prediction density of each bin
+        :param pixel_counts: number of pixels of each bin
+        :param max_iterations: maximum number of iterations of the iterative AR solver
+        :return: density of each bin the AR applies to
+        :raises ValueError: if the iterative solver reaches the maximum number of iterations
         '''
+        if self.ar_solver == 'exact':
+            summary.AR, summary.achieved_deforestation = self.solve_adjustment_ratio(
+                bin_densities, pixel_counts, summary.maximum_density, summary.target_deforestation)
+            return bin_densities
 
-        # Calculate the maximum density
-        # Calculate areal_resolution_of_map_pixels
-        in_ds4 = gdal.Open(risk30_vp)
-        P1 = in_ds4.GetGeoTransform()[1]
-        P2 = abs(in_ds4.GetGeoTransform()[5])
-        maximum_density = P1 * P2 / 10000
-
-        # Adjusted_Prediction_Density_Map = AR x Prediction_Density _Map
-        adjusted_prediction_density_arr=AR*prediction_density_arr
-
-        # Reclassify all pixels greater than the maximum (e.g., 0.09) to be the maximum
-        adjusted_prediction_density_arr[adjusted_prediction_density_arr > maximum_density] = maximum_density
+        AR = self.calculate_adjustment_ratio(bin_densities, summary.target_deforestation, pixel_counts)
+        # Iterative solver: set a maximum number of iterations to avoid infinite loop
+        iteration_count = 0
+        new_bin_densities = None
 
-        # Create imagery
-        self.array_to_image(risk30_vp, out_fn2, adjusted_prediction_density_arr, gdal.GDT_Float32, -1)
+        # When AR > 1.00001 and iteration_count <= max_iterations, treat the result as new prediction density map to iterate the AR util AR is <=1.00001 or iteration_count = max_iterations
+        while AR > 1.00001 and iteration_count <= max_iterations:
+            new_bin_densities = self.cap_adjusted_density(bin_densities, AR, summary.maximum_density)
+            AR = self.calculate_adjustment_ratio(new_bin_densities, summary.target_deforestation, pixel_counts)
+            iteration_count += 1
+        summary.AR = AR
+        summary.iterations = iteration_count
+        if iteration_count > int(max_iterations):
+            summary.achieved_deforestation = None
+            raise ValueError("Maximum number of iterations reached. Please reset the maximum number of iterations.")
+
+        selected_bin_densities = new_bin_densities if new_bin_densities is not None else bin_densities
+        summary.achieved_deforestation = self.modeled_deforestation(
+            self.cap_adjusted_density(selected_bin_densities, AR, summary.maximum_density), pixel_counts)
+        return selected_bin_densities
+
+    def adjusted_density_lut(self, bin_ids, bin_densities, summary, time=None):
+        '''
+        Dense lookup vector from the tabulation bin ids to the adjusted prediction density
+        :param bin_ids: bin ids of the prediction density table
+        :param bin_densities: density of each bin
+        :param summary: PredictionRunSummary with the AR and the maximum density
+        :param time: number of years in the VP for an annual map, None for the CNF
+        :return: float32 array indexed by bin id
+        '''
+        # Adjusted density of each bin, with the same float32 operations as the map
+        adjusted_bin_densities = self.cap_adjusted_density(bin_densities, summary.AR, summary.maximum_density)
+        if time is not None:
+            # Convert the result back to an annual rate by dividing by the number of years in the VP
+            adjusted_bin_densities = adjusted_bin_densities / time
 
-        return
+        density_lut = np.zeros(int(bin_ids.max()) + 1, dtype=np.float32)
+        density_lut[bin_ids] = adjusted_bin_densities
+        return density_lut
 
-    def adjusted_prediction_density_map_annual (self, prediction_density_arr, risk30_vp, AR, out_fn2, time):
+    def write_density_maps(self, tabulation_bin_id_masked, in_fn, density_maps, ref_fn=None):
         '''
-        Create adjusted prediction density map for annual
-        :param prediction_density_arr:modeled deforestation (MD)
+        Write several density maps in one pass over the tabulation bin ids
+        The lookups of all maps run on the worker pool block by block, every map is written as its blocks are done
+        :param tabulation_bin_id_masked: tabulation bin id map or array
+        :param in_fn: datasource to copy projection and geotransform from
+        :param density_maps: list of (density_lut, out_fn)
+        :param ref_fn: datasource to copy the RST reference system name from, in_fn by default
+        '''
+        density_luts = [density_lut for density_lut, _ in density_maps]
+        with ExitStack() as stack:
+            # Every map is written by its own background thread while the next blocks are looked up
+            writers = [stack.enter_context(RasterWriter(in_fn, out_fn, gdal.GDT_Float32, -1, self.write_profile,
+                                                        ref_fn, background=True))
+                       for _, out_fn in density_maps]
+            density_blocks = map_blocks(lambda bin_id_block: [density_lut[bin_id_block] for density_lut in density_luts],
+                                        self.iter_bin_id_blocks(tabulation_bin_id_masked), self.workers)
+            for window, blocks in density_blocks:
+                for writer, density_block in zip(writers, blocks):
+                    writer.write(window, density_block)
+
+    def adjusted_prediction_density_bin_map(self, tabulation_bin_id_VP_masked, bin_ids, bin_densities, risk30_vp,
+                                            summary, out_fn2, time=None, ref_fn=None):
+        '''
+        Create adjusted prediction density map from the density of each bin, the map is rasterized once
+        :param tabulation_bin_id_VP_masked: tabulation bin id map or array in CNF/VP
+        :param bin_ids: bin ids of the prediction density table
+        :param bin_densities: density of each bin
         :param risk30_vp: risk30_vp image
-        :param AR:Adjustment Ratio
+        :param summary: PredictionRunSummary with the AR and the maximum density
         :param out_fn2: user input
+        :param time: number of years in the VP for an annual map, None for the CNF
+        :param ref_fn: datasource to copy the RST reference system name from, risk30_vp by default
         :return:
         '''
-
-        # Calculate the maximum density
-        # Calculate areal_resolution_of_map_pixels
-        in_ds4 = gdal.Open(risk30_vp)
-        P1 = in_ds4.GetGeoTransform()[1]
-        P2 = abs(in_ds4.GetGeoTransform()[5])
-        maximum_density = P1 * P2 / 10000
-
-        # Adjusted_Prediction_Density_Map = AR x Prediction_Density _Map
-        adjusted_prediction_density_arr=AR*prediction_density_arr
-
-        # Reclassify all pixels greater than the maximum (e.g., 0.09) to be the maximum
-        adjusted_prediction_density_arr[adjusted_prediction_density_arr > maximum_density] = maximum_density
-
-        # Convert the result back to an annual rate by dividing by the number of years in the VP
-        adjusted_prediction_density_arr_annual=adjusted_prediction_density_arr/time
+        density_lut = self.adjusted_density_lut(bin_ids, bin_densities, summary, time)
 
         # Create imagery
-        self.array_to_image(risk30_vp, out_fn2, adjusted_prediction_density_arr_annual, gdal.GDT_Float32, -1)
+        self.write_density_maps(tabulation_bin_id_VP_masked, risk30_vp, [(density_lut, out_fn2)], ref_fn)
 
         return
 
@@ -362,29 +716,10 @@ class AllocationTool(QObject):
          :param in_fn: datasource to copy correct projection name
          :param out_fn: rst raster file
         '''
-        if out_fn.split('.')[-1] == 'rst':
-            read_file_name, _ = os.path.splitext(in_fn)
-            write_file_name, _ = os.path.splitext(out_fn)
-            temp_file_path = 'rdc_temp.rdc'
-
-            with open(read_file_name + '.rdc', 'r') as read_file:
-                for line in read_file:
-                    if line.startswith("ref. system :"):
-                        correct_name=line
-                        break
-
-            if correct_name:
-                with open(write_file_name + '.rdc', 'r') as read_file, open(temp_file_path, 'w') as write_file:
-                    for line in read_file:
-                        if line.startswith("ref. system :"):
-                            write_file.write(correct_name)
-                        else:
-                            write_file.write(line)
-
-                # Move the temp file to replace the original
-                shutil.move(temp_file_path, write_file_name + '.rdc')
+        fix_ref_system(in_fn, out_fn)
 
 
+    @releases_datasets
     def execute_workflow_fit(self, directory,risk30_hrp,municipality, deforestation_hrp, csv_name, out_fn1, out_fn2):
         '''
         Create workflow function for CAL and HRP
@@ -392,29 +727,28 @@ class AllocationTool(QObject):
         self.progress_updated.emit(0)
         data_folder = self.set_working_directory(directory)
         self.progress_updated.emit(10)
-        tabulation_bin_id_masked = self.tabulation_bin_id_HRP(risk30_hrp,municipality,out_fn1)
-        self.replace_ref_system(municipality, out_fn1)
+        # The bin id map is streamed to disk and counted in the same pass, only the density map reads it back
+        area_counts, deforestation_counts = self.tabulation_bin_id_HRP(risk30_hrp, municipality, out_fn1,
+                                                                       deforestation_hrp)
         self.progress_updated.emit(50)
-        merged_df = self.create_relative_frequency_table(tabulation_bin_id_masked,
-                                                                              deforestation_hrp, csv_name)
+        merged_df = self.relative_frequency_table(area_counts, deforestation_counts, csv_name)
         self.progress_updated.emit(75)
-        self.create_fit_density_map(risk30_hrp, tabulation_bin_id_masked,
-                                                              merged_df, out_fn2)
-        self.replace_ref_system(municipality, out_fn2)
+        self.create_fit_density_map(risk30_hrp, out_fn1, merged_df, out_fn2, municipality)
         self.progress_updated.emit(100)
         # After processing, emit processCompleted or any other signal as needed
         return
 
+    @releases_datasets
     def execute_workflow_cnf(self, directory, max_iterations, csv, municipality, deforestation_cnf, risk30_vp, out_fn1, out_fn2):
         '''
         Create workflow function for CNF
-        :param max_iterations: maximum number of iterations
+        The AR, target and modeled deforestation of the run are kept in run_summary
+        :param max_iterations: maximum number of iterations of the iterative AR solver
         '''
         self.progress_updated.emit(0)
         data_folder = self.set_working_directory(directory)
         self.progress_updated.emit(10)
         tabulation_bin_id_VP_masked = self.tabulation_bin_id_VP(risk30_vp, municipality, out_fn1)
-        self.replace_ref_system(municipality, out_fn1)
         self.progress_updated.emit(30)
 
         # Check modeling region IDs present in the prediction stage but absent in the fitting stage
@@ -426,41 +760,37 @@ class AllocationTool(QObject):
 
         self.progress_updated.emit(40)
 
-        prediction_density_arr = self.calculate_prediction_density_arr(risk30_vp, tabulation_bin_id_VP_masked,csv)
+        # The AR is solved on the density of each bin, the map is rasterized once at the end
+        bin_ids, bin_densities, pixel_counts = self.calculate_prediction_density_table(risk30_vp,
+                                                                                       tabulation_bin_id_VP_masked, csv)
         self.progress_updated.emit(50)
-        AR = self.calculate_adjustment_ratio_cnf(prediction_density_arr, deforestation_cnf)
+        # Values computed once for the run, AD is counted in a single pass over the deforestation map
+        summary = PredictionRunSummary()
+        summary.maximum_density = self.calculate_maximum_density(risk30_vp)
+        summary.actual_deforestation = self.calculate_actual_deforestation(deforestation_cnf)
+        summary.target_deforestation = summary.actual_deforestation
+        self.run_summary = summary
+
+        selected_bin_densities = self.allocate_bin_densities(summary, bin_densities, pixel_counts, max_iterations)
         self.progress_updated.emit(75)
-        # Set a maximum number of iterations to avoid infinite loop
-        iteration_count = 0
-        new_prediction_density_arr = None
-
-        # When AR > 1.00001 and iteration_count <= max_iterations, treat the result as new prediction density map to iterate the AR util AR is <=1.00001 or iteration_count = max_iterations
-        while AR > 1.00001 and iteration_count <= max_iterations:
-            new_prediction_density_arr = self.adjusted_prediction_density_array(prediction_density_arr, risk30_vp, AR)
-            AR = self.calculate_adjustment_ratio_cnf(new_prediction_density_arr, deforestation_cnf)
-            iteration_count += 1
-        if iteration_count <= int(max_iterations):
-            selected_density_arr = new_prediction_density_arr if new_prediction_density_arr is not None else prediction_density_arr
-            self.adjusted_prediction_density_map(selected_density_arr, risk30_vp, AR, out_fn2)
-            self.replace_ref_system(municipality, out_fn2)
-
-        else:
-            print("Maximum number of iterations reached. Please reset the maximum number of iterations.")
+        self.adjusted_prediction_density_bin_map(tabulation_bin_id_VP_masked, bin_ids, selected_bin_densities,
+                                                 risk30_vp, summary, out_fn2, ref_fn=municipality)
 
         self.progress_updated.emit(100)
 
         return id_difference
 
+    @releases_datasets
     def execute_workflow_vp(self, directory,max_iterations, csv, municipality, expected_deforestation, risk30_vp, out_fn1, out_fn2, time):
         '''
         Create workflow function for VP
-        :param max_iterations: maximum number of iterations
+        The AR, target and modeled deforestation of the run are kept in run_summary
+        :param max_iterations: maximum number of iterations of the iterative AR solver
         '''
         self.progress_updated.emit(0)
         data_folder = self.set_working_directory(directory)
         self.progress_updated.emit(10)
         tabulation_bin_id_VP_masked = self.tabulation_bin_id_VP(risk30_vp, municipality, out_fn1)
-        self.replace_ref_system(municipality, out_fn1)
         self.progress_updated.emit(30)
 
         # Check modeling region IDs present in the prediction stage but absent in the fitting stage
@@ -472,31 +802,74 @@ class AllocationTool(QObject):
 
         self.progress_updated.emit(40)
 
-        prediction_density_arr = self.calculate_prediction_density_arr(risk30_vp, tabulation_bin_id_VP_masked,csv)
+        # The AR is solved on the density of each bin, the map is rasterized once at the end
+        bin_ids, bin_densities, pixel_counts = self.calculate_prediction_density_table(risk30_vp,
+                                                                                       tabulation_bin_id_VP_masked, csv)
         self.progress_updated.emit(50)
-        AR = self.calculate_adjustment_ratio(prediction_density_arr, expected_deforestation)
-        self.progress_updated.emit(75)
-        # Set a maximum number of iterations to avoid infinite loop
-        iteration_count = 0
-        new_prediction_density_arr = None
+        # Values computed once for the run
+        summary = PredictionRunSummary()
+        summary.maximum_density = self.calculate_maximum_density(risk30_vp)
+        summary.target_deforestation = expected_deforestation
+        self.run_summary = summary
 
-        # When AR > 1.00001 and iteration_count <= max_iterations, treat the result as new prediction density map to iterate the AR util AR is <=1.00001 or iteration_count = max_iterations
-        while AR > 1.00001 and iteration_count <= max_iterations:
-            new_prediction_density_arr = self.adjusted_prediction_density_array(prediction_density_arr, risk30_vp, AR)
-            AR = self.calculate_adjustment_ratio(new_prediction_density_arr, expected_deforestation)
-            iteration_count += 1
-            # Emitting progress based on the current iteration_count and max_iterations
-        if iteration_count <= int(max_iterations):
-            selected_density_arr = new_prediction_density_arr if new_prediction_density_arr is not None else prediction_density_arr
-            self.adjusted_prediction_density_map_annual(selected_density_arr, risk30_vp, AR, out_fn2, time)
-            self.replace_ref_system(municipality, out_fn2)
-        else:
-            print("Maximum number of iterations reached. Please reset the maximum number of iterations.")
+        selected_bin_densities = self.allocate_bin_densities(summary, bin_densities, pixel_counts, max_iterations)
+        self.progress_updated.emit(75)
+        self.adjusted_prediction_density_bin_map(tabulation_bin_id_VP_masked, bin_ids, selected_bin_densities,
+                                                 risk30_vp, summary, out_fn2, time, municipality)
 
         self.progress_updated.emit(100)
 
         return id_difference
 
+    @releases_datasets
+    def execute_workflow_vp_scenarios(self, directory, max_iterations, csv, municipality, risk30_vp, out_fn1, scenarios):
+        '''
+        Create workflow function for several VP scenarios
+        The modeling region map and the prediction density table are built once, the AR is solved for each
+        scenario on the table and the annual density maps are written in one pass over the bin ids.
+        :param max_iterations: maximum number of iterations of the iterative AR solver
+        :param scenarios: list of (expected_deforestation, time, out_fn2)
+        :return: id_difference, summaries: PredictionRunSummary of each scenario
+        '''
+        self.progress_updated.emit(0)
+        data_folder = self.set_working_directory(directory)
+        self.progress_updated.emit(10)
+        tabulation_bin_id_VP_masked = self.tabulation_bin_id_VP(risk30_vp, municipality, out_fn1)
+        self.progress_updated.emit(30)
+
+        # Check modeling region IDs present in the prediction stage but absent in the fitting stage
+        id_difference = self.check_modeling_region_ids(csv, out_fn1)
+
+        # If there are missing bins, calculate the relative frequency and create a new csv file
+        if id_difference.size > 0:
+            self.calculate_missing_bins_rf(id_difference, csv)
+
+        self.progress_updated.emit(40)
+
+        bin_ids, bin_densities, pixel_counts = self.calculate_prediction_density_table(risk30_vp,
+                                                                                       tabulation_bin_id_VP_masked, csv)
+        self.progress_updated.emit(50)
+        maximum_density = self.calculate_maximum_density(risk30_vp)
+
+        # Solve the AR of each scenario on the bin table
+        summaries = []
+        density_maps = []
+        for expected_deforestation, time, out_fn2 in scenarios:
+            summary = PredictionRunSummary()
+            summary.maximum_density = maximum_density
+            summary.target_deforestation = expected_deforestation
+            summaries.append(summary)
+            selected_bin_densities = self.allocate_bin_densities(summary, bin_densities, pixel_counts, max_iterations)
+            density_maps.append((self.adjusted_density_lut(bin_ids, selected_bin_densities, summary, time), out_fn2))
+        self.progress_updated.emit(60)
+
+        # Write the annual density maps of all scenarios
+        self.write_density_maps(tabulation_bin_id_VP_masked, risk30_vp, density_maps, municipality)
+
+        self.progress_updated.emit(100)
+
+        return id_difference, summaries
+
     def check_modeling_region_ids(self, csv, out_fn):
         '''
         Check modeling region IDs present in the prediction stage but absent in the fitting stage.
@@ -504,9 +877,12 @@ class AllocationTool(QObject):
         :param out_fn: modeling region image in prediction stage
         :return: id_difference: A set of modeling region IDs np array that exist only in the prediction stage
         '''
-        fit_model_region_id = pd.read_csv(csv)['ID'].to_numpy()
-        pre_model_region_arr = self.image_to_array(out_fn)
-        pre_model_region_id = np.unique(pre_model_region_arr[pre_model_region_arr != 0])
+        fit_model_region_id = self.read_relative_frequency_table(csv)['ID'].to_numpy()
+        # Collect the modeling region IDs block by block
+        pre_model_region_id = np.array([], dtype=np.int64)
+        for _, (pre_model_region_arr,) in self.iter_bin_id_blocks(out_fn):
+            block_id = np.unique(pre_model_region_arr[pre_model_region_arr != 0])
+            pre_model_region_id = np.union1d(pre_model_region_id, block_id)
         id_difference = np.setdiff1d(pre_model_region_id, fit_model_region_id)
 
         return id_difference
@@ -520,7 +896,7 @@ class AllocationTool(QObject):
         :return
         '''
         # Convert modeling region ids to vulnerability zone id
-        df=pd.read_csv(csv)
+        df=self.read_relative_frequency_table(csv)
         df['v_zone'] = (df['ID'] // 1000).astype(int)
 
         # Convert missing bin ids to vulnerability zone id
@@ -558,4 +934,6 @@ class AllocationTool(QObject):
         shutil.copyfile(csv, csv.split('.')[0] + '_orig' + '.csv')
 
         # Save the new result to csv
-        df_new.to_csv(csv, index=False)
\ No newline at end of file
+        df_new.to_csv(csv, index=False)
+        # Store the bin table with the values as parsed from the csv
+        self.read_relative_frequency_table(csv)
\ No newline at end of file
@@ -14,11 +14,14 @@ import pandas as pd
 from PyQt5.QtCore import QObject, pyqtSignal
 import shutil
 from geopandas import GeoDataFrame
+from .raster_io import (iter_blocks, read_array, open_dataset, raster_info, evict, clear_cache, driver_name,
+                        creation_options, WriteProfileMixin, RasterWriter, fix_ref_system, minimal_integer_type,
+                        build_overviews)
 
 # GDAL exceptions
 gdal.UseExceptions()
 
-class ModelEvaluation(QObject):
+class ModelEvaluation(QObject, WriteProfileMixin):
     progress_updated = pyqtSignal(int)
     def __init__(self):
         super(ModelEvaluation, self).__init__()
@@ -34,12 +37,8 @@ class ModelEvaluation(QObject):
         os.chdir(self.data_folder)
 
     def image_to_array(self,image):
-        # Set up a GDAL dataset
-        in_ds = gdal.Open(image)
-        # Set up a GDAL band
-        in_band = in_ds.GetRasterBand(1)
-        # Create Numpy Array1
-        arr = in_band.ReadAsArray()
+        # TerrSet binary rasters are memory-mapped, other formats are read through GDAL
+        arr = read_array(image)
         return arr
 
     def array_to_image(self, in_fn, out_fn, data, data_type, nodata=None):
@@ -52,22 +51,9 @@ class ModelEvaluation(QObject):
          :param nodata:optional NoData value
          :return:
         '''
-        in_ds = gdal.Open(in_fn)
-        output_format = out_fn.split('.')[-1].upper()
-        if (output_format == 'TIF'):
-            output_format = 'GTIFF'
-        elif (output_format == 'RST'):
-            output_format = 'rst'
-        driver = gdal.GetDriverByName(output_format)
-        out_ds = driver.Create(out_fn, in_ds.RasterXSize, in_ds.RasterYSize, 1, data_type, options=["BigTIFF=YES"])
-        out_band = out_ds.GetRasterBand(1)
-        out_ds.SetGeoTransform(in_ds.GetGeoTransform())
-        out_ds.SetProjection(in_ds.GetProjection().encode('utf-8', 'backslashreplace').decode('utf-8'))
-        if nodata is not None:
-            out_band.SetNoDataValue(nodata)
-        out_band.WriteArray(data)
-        out_band.FlushCache()
-        out_ds.FlushCache()
+        # Write the whole array as a single window
+        with RasterWriter(in_fn, out_fn, data_type, nodata, self.write_profile) as writer:
+            writer.write((0, 0, data.shape[1], data.shape[0]), data)
         return
 
     def replace_ref_system(self, in_fn, out_fn):
@@ -76,27 +62,7 @@ class ModelEvaluation(QObject):
          :param in_fn: datasource to copy correct projection name
          :param out_fn: rst raster file
         '''
-        if out_fn.split('.')[-1] == 'rst':
-            read_file_name, _ = os.path.splitext(in_fn)
-            write_file_name, _ = os.path.splitext(out_fn)
-            temp_file_path = 'rdc_temp.rdc'
-
-            with open(read_file_name + '.rdc', 'r') as read_file:
-                for line in read_file:
-                    if line.startswith("ref. system :"):
-                        correct_name=line
-                        break
-
-            if correct_name:
-                with open(write_file_name + '.rdc', 'r') as read_file, open(temp_file_path, 'w') as write_file:
-                    for line in read_file:
-                        if line.startswith("ref. system :"):
-                            write_file.write(correct_name)
-                        else:
-                            write_file.write(line)
-
-                # Move the temp file to replace the original
-                shutil.move(temp_file_path, write_file_name + '.rdc')
+        fix_ref_system(in_fn, out_fn)
 
     def replace_legend(self, out_fn):
         '''
@@ -118,6 +84,7 @@ class ModelEvaluation(QObject):
                     else:
                         write_file.write(line)
             shutil.move(temp_file_path, base_name + '.rdc')
+            evict(out_fn)
 
     def create_mask_polygon(self, mask):
         '''
@@ -125,7 +92,7 @@ class ModelEvaluation(QObject):
         :param mask: mask of the jurisdiction (binary map)
         :return:
         '''
-        in_ds = gdal.Open(mask)
+        in_ds = open_dataset(mask)
         in_band = in_ds.GetRasterBand(1)
 
         # Set up osr spatial reference
@@ -300,18 +267,15 @@ class ModelEvaluation(QObject):
         source_ds = ogr.Open(vector_fn)
         source_layer = source_ds.GetLayer()
 
-        in_ds = gdal.Open(in_fn)
-        output_format = raster_fn.split('.')[-1].upper()
-        if (output_format == 'TIF'):
-            output_format = 'GTIFF'
-        elif (output_format == 'RST'):
-            output_format = 'rst'
+        in_info = raster_info(in_fn)
+        evict(raster_fn)
+        output_format = driver_name(raster_fn)
         driver = gdal.GetDriverByName(output_format)
-        out_ds = driver.Create(raster_fn, in_ds.RasterXSize, in_ds.RasterYSize, 1, data_type, options=["BigTIFF=YES"])
+        out_ds = driver.Create(raster_fn, in_info.x_size, in_info.y_size, 1, data_type, options=creation_options(output_format, data_type, self.write_profile))
         out_band = out_ds.GetRasterBand(1)
-        out_ds.SetGeoTransform(in_ds.GetGeoTransform())
+        out_ds.SetGeoTransform(in_info.geotransform)
 
-        out_ds.SetProjection(in_ds.GetProjection().encode('utf-8', 'backslashreplace').decode('utf-8'))
+        out_ds.SetProjection(in_info.projection.encode('utf-8', 'backslashreplace').decode('utf-8'))
 
         if nodata is not None:
             out_band.SetNoDataValue(nodata)
@@ -321,6 +285,12 @@ class ModelEvaluation(QObject):
         # Cleanup
         out_band.FlushCache()
         out_ds.FlushCache()
+        out_band = None
+        out_ds = None
+
+        # Cloud-Optimized GeoTIFF output mode
+        if self.write_profile == 'cog':
+            build_overviews(raster_fn, data_type)
         return
 
     def remove_edge_cells(self, full_voronoi_grid: GeoDataFrame, area_mask: GeoDataFrame,
@@ -360,16 +330,17 @@ class ModelEvaluation(QObject):
         mask_df = gpd.GeoDataFrame.from_file('POLYGONIZED_MASK.shp')
 
         # Calculate grid size
-        in_ds = gdal.Open(mask)
-        grid_size = int(np.sqrt(grid_area * 10000)) // int(in_ds.GetGeoTransform()[1])
+        in_info = raster_info(mask)
+        geotransform = in_info.geotransform
+        grid_size = int(np.sqrt(grid_area * 10000)) // int(geotransform[1])
 
         # Systematic Sampling
         sample_points = []
-        for y in range(-1 * grid_size, in_ds.RasterYSize + 1 * grid_size, grid_size):
-            for x in range(-1 * grid_size, in_ds.RasterXSize + 1 * grid_size, grid_size):
+        for y in range(-1 * grid_size, in_info.y_size + 1 * grid_size, grid_size):
+            for x in range(-1 * grid_size, in_info.x_size + 1 * grid_size, grid_size):
                 # Convert raster coordinates to geographic coordinates
-                geo_x = in_ds.GetGeoTransform()[0] + x * in_ds.GetGeoTransform()[1]
-                geo_y = in_ds.GetGeoTransform()[3] + y * in_ds.GetGeoTransform()[5]
+                geo_x = geotransform[0] + x * geotransform[1]
+                geo_y = geotransform[3] + y * geotransform[5]
                 sample_points.append((geo_x, geo_y))
 
         # Convert sample_points list to DataFrame
@@ -428,9 +399,9 @@ class ModelEvaluation(QObject):
         self.progress_updated.emit(50)
 
         # Calculate areal_resolution_of_map_pixels
-        in_ds4 = gdal.Open(density)
-        P1 = in_ds4.GetGeoTransform()[1]
-        P2 = abs(in_ds4.GetGeoTransform()[5])
+        geotransform = raster_info(density).geotransform
+        P1 = geotransform[1]
+        P2 = abs(geotransform[5])
         areal_resolution_of_map_pixels = P1 * P2 / 10000
 
         # Add the results back to the GeoDataFrame
@@ -476,18 +447,17 @@ class ModelEvaluation(QObject):
 
     def create_deforestation_map (self, fmask, deforestation_cal, deforestation_cnf, out_fn_def):
         self.progress_updated.emit(80)
-        arr_fmask = self.image_to_array(fmask)
-        arr_def_cal = self.image_to_array(deforestation_cal)
-        arr_def_cnf = self.image_to_array(deforestation_cnf)
+        # Read the three inputs block by block and stream the deforestation_map (classes 0 to 3) to disk
+        data_type, _ = minimal_integer_type(0, 3)
+        with RasterWriter(fmask, out_fn_def, data_type, None, self.write_profile) as writer:
+            for window, (arr_fmask, arr_def_cal, arr_def_cnf) in iter_blocks(fmask, deforestation_cal, deforestation_cnf):
+                deforestation_arr = np.copy(arr_fmask)
 
-        deforestation_arr=np.copy(arr_fmask)
+                deforestation_arr[arr_def_cnf == 1] = 3
+                deforestation_arr[(arr_def_cnf == 0) & (arr_def_cal == 1)] = 2
+                deforestation_arr[(arr_def_cnf == 0) & (arr_def_cal == 0) & (arr_fmask == 1)] = 1
 
-        deforestation_arr[arr_def_cnf == 1] = 3
-        deforestation_arr[(arr_def_cnf == 0) & (arr_def_cal == 1)] = 2
-        deforestation_arr[(arr_def_cnf == 0) & (arr_def_cal == 0) & (fmask == 1)] = 1
-
-        #write deforestation_map
-        self.array_to_image(fmask, out_fn_def, deforestation_arr, gdal.GDT_Int16, -1)
+                writer.write(window, deforestation_arr)
 
         return
 
@@ -590,6 +560,9 @@ class ModelEvaluation(QObject):
         return
 
     def remove_temp_files(self):
+        # Close cached datasets so the files can be deleted
+        clear_cache()
+
         # Files to check for and delete
         mask_file = 'mask'
         shapefiles_to_delete = ["TEMP_POLYGONIZED","POLYGONIZED_MASK","thiessen_polygon_temp","temp_vector"]
@@ -0,0 +1,689 @@
+import os
+import sys
+import queue
+import shutil
+import tempfile
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, namedtuple, deque
+import numpy as np
+from osgeo import gdal
+
+# GDAL exceptions
+gdal.UseExceptions()
+
+# Target number of pixels held in memory per block and per input raster
+BLOCK_PIXELS = 4 * 1024 * 1024
+
+# Maximum size of the input strips queued or processed by map_blocks at a time (8 strips of float64),
+# independent of the number of CPUs
+IN_FLIGHT_BYTES = 8 * BLOCK_PIXELS * 8
+
+# Maximum number of datasets kept open by open_dataset
+DATASET_CACHE_SIZE = 32
+
+# Metadata of an open dataset: geotransform, projection, size, band data type (GDAL code) and block size
+RasterInfo = namedtuple('RasterInfo', ['geotransform', 'projection', 'x_size', 'y_size', 'data_type', 'block_size'])
+
+# Process-wide LRU cache of (path, mtime, size) -> (dataset, RasterInfo)
+_dataset_cache = OrderedDict()
+_dataset_cache_lock = threading.Lock()
+
+# GeoTIFF creation options of the write profiles, 'striped' is the plain BigTIFF layout
+WRITE_PROFILES = {
+    'striped': {'BIGTIFF': 'YES'},
+    'deflate': {'BIGTIFF': 'YES', 'TILED': 'YES', 'BLOCKXSIZE': '512', 'BLOCKYSIZE': '512',
+                'COMPRESS': 'DEFLATE', 'NUM_THREADS': 'ALL_CPUS'},
+    'zstd': {'BIGTIFF': 'YES', 'TILED': 'YES', 'BLOCKXSIZE': '512', 'BLOCKYSIZE': '512',
+             'COMPRESS': 'ZSTD', 'NUM_THREADS': 'ALL_CPUS'},
+    'lzw': {'BIGTIFF': 'YES', 'TILED': 'YES', 'BLOCKXSIZE': '512', 'BLOCKYSIZE': '512',
+            'COMPRESS': 'LZW', 'NUM_THREADS': 'ALL_CPUS'},
+}
+# 'cog' writes a tiled GeoTIFF like 'deflate' and converts it to a Cloud-Optimized GeoTIFF with internal
+# overviews once it is complete (external .ovr overviews for RST outputs)
+WRITE_PROFILES['cog'] = WRITE_PROFILES['deflate']
+DEFAULT_WRITE_PROFILE = 'deflate'
+
+# Creation options of the COG driver, the overview resampling is added per data type
+COG_OPTIONS = ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BIGTIFF=IF_SAFER', 'BLOCKSIZE=512', 'NUM_THREADS=ALL_CPUS']
+
+# Overviews stop once the smallest side is below this number of pixels
+MIN_OVERVIEW_SIZE = 256
+
+# GDAL floating point data types, compressed with the floating point predictor
+FLOAT_DATA_TYPES = (gdal.GDT_Float32, gdal.GDT_Float64)
+
+# Integer output types from smallest to largest: (GDAL data type, NumPy dtype)
+INTEGER_TYPES = [
+    (gdal.GDT_Byte, np.dtype(np.uint8)),
+    (gdal.GDT_Int16, np.dtype(np.int16)),
+    (gdal.GDT_UInt16, np.dtype(np.uint16)),
+    (gdal.GDT_Int32, np.dtype(np.int32)),
+    (gdal.GDT_UInt32, np.dtype(np.uint32)),
+]
+
+# TerrSet binary data types that map directly onto a NumPy dtype (always little-endian)
+RST_DATA_TYPES = {'byte': np.dtype('u1'), 'integer': np.dtype('<i2'), 'real': np.dtype('<f4')}
+
+def file_key(image):
+    '''
+    Identity of a file on disk (path, modification time and size), used as cache key of the file and of the
+    results derived from it, None if the source is not a plain file (e.g. a GDAL virtual path)
+    '''
+    path = os.path.abspath(image)
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+def open_dataset(image):
+    '''
+    Open a raster read-only through a process-wide cache, a file is reopened once it changes on disk
+    The returned dataset is shared: do not modify it or use it from several threads at once
+    :param image: raster path
+    :return: gdal.Dataset
+    '''
+    return _open_cached(image)[0]
+
+def raster_info(image):
+    '''
+    Cached metadata of a raster
+    :param image: raster path
+    :return: RasterInfo
+    '''
+    return _open_cached(image)[1]
+
+def _open_cached(image):
+    key = file_key(image)
+    if key is not None:
+        with _dataset_cache_lock:
+            entry = _dataset_cache.get(key)
+            if entry is not None:
+                _dataset_cache.move_to_end(key)
+                return entry
+
+    in_ds = gdal.Open(image)
+    in_band = in_ds.GetRasterBand(1)
+    info = RasterInfo(in_ds.GetGeoTransform(), in_ds.GetProjection(), in_ds.RasterXSize, in_ds.RasterYSize,
+                      in_band.DataType, tuple(in_band.GetBlockSize()))
+    entry = (in_ds, info)
+    if key is not None:
+        with _dataset_cache_lock:
+            # Drop stale entries of the same file before adding the new one
+            for stale_key in [k for k in _dataset_cache if k[0] == key[0]]:
+                del _dataset_cache[stale_key]
+            _dataset_cache[key] = entry
+            while len(_dataset_cache) > DATASET_CACHE_SIZE:
+                _dataset_cache.popitem(last=False)
+    return entry
+
+def evict(image):
+    '''
+    Close the cached dataset of a file, call this before overwriting or deleting it
+    :param image: raster path
+    '''
+    path = os.path.abspath(image)
+    with _dataset_cache_lock:
+        for key in [k for k in _dataset_cache if k[0] == path]:
+            del _dataset_cache[key]
+
+def clear_cache():
+    '''
+    Close all cached datasets
+    '''
+    with _dataset_cache_lock:
+        _dataset_cache.clear()
+
+def releases_datasets(function):
+    '''
+    Decorator for workflow entry points: close all cached datasets when the run returns or fails,
+    so no input file stays open (and locked on Windows) between runs
+    :param function: entry point
+    :return: wrapped entry point
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            clear_cache()
+    return wrapper
+
+def creation_options(output_format, data_type, profile=DEFAULT_WRITE_PROFILE):
+    '''
+    Driver creation options for an output raster
+    :param output_format: GDAL driver name, options only apply to GTIFF
+    :param data_type: output data type
+    :param profile: name in WRITE_PROFILES, or a dictionary of GeoTIFF creation options
+    :return: list of creation options
+    '''
+    if output_format.upper() != 'GTIFF':
+        return []
+    if isinstance(profile, dict):
+        options = dict(profile)
+    elif profile in WRITE_PROFILES:
+        options = dict(WRITE_PROFILES[profile])
+    else:
+        raise ValueError(f"Unknown write profile '{profile}', expected one of {', '.join(WRITE_PROFILES)}")
+    # Horizontal differencing for integers, floating point prediction for reals
+    if options.get('COMPRESS', 'NONE').upper() in ('DEFLATE', 'ZSTD', 'LZW') and 'PREDICTOR' not in options:
+        options['PREDICTOR'] = '3' if data_type in FLOAT_DATA_TYPES else '2'
+    return [f"{key}={value}" for key, value in options.items()]
+
+def minimal_integer_type(min_value, max_value):
+    '''
+    Smallest integer output type that holds every value in [min_value, max_value]
+    :param min_value: lowest value to store, including the NoData value
+    :param max_value: highest value to store
+    :return: (GDAL data type, NumPy dtype)
+    '''
+    for data_type, dtype in INTEGER_TYPES:
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return data_type, dtype
+    raise ValueError(f"No integer raster type can hold values from {min_value} to {max_value}")
+
+def read_rdc(image):
+    '''
+    Parse the .rdc header of a TerrSet raster
+    :param image: path of the .rst file
+    :return: dictionary of lower-case header keys and their values, or None if there is no .rdc file
+    '''
+    rdc_fn = os.path.splitext(image)[0] + '.rdc'
+    if not os.path.exists(rdc_fn):
+        return None
+    header = {}
+    with open(rdc_fn, 'r') as read_file:
+        for line in read_file:
+            key, sep, value = line.partition(':')
+            if sep:
+                # Keep the first occurrence, legend and lineage entries may repeat keys
+                header.setdefault(key.strip().lower(), value.strip())
+    return header
+
+def read_rst(image):
+    '''
+    Map a TerrSet binary raster into memory without copying it
+    :param image: path of the .rst file
+    :return: copy-on-write np.memmap of shape (rows, columns), or None if the file can not be mapped directly
+    '''
+    if os.path.splitext(image)[1].lower() != '.rst':
+        return None
+    header = read_rdc(image)
+    if header is None or header.get('file type', '').lower() != 'binary':
+        return None
+    dtype = RST_DATA_TYPES.get(header.get('data type', '').lower())
+    if dtype is None:
+        return None
+    try:
+        shape = (int(header['rows']), int(header['columns']))
+    except (KeyError, ValueError):
+        return None
+    if os.path.getsize(image) != shape[0] * shape[1] * dtype.itemsize:
+        return None
+    # Copy-on-write: callers may modify the array without touching the file on disk
+    return np.memmap(image, dtype=dtype, mode='c', shape=shape)
+
+def read_array(image):
+    '''
+    Read the first band of a raster, TerrSet binary rasters are memory-mapped instead of read
+    :param image: raster path
+    :return: NumPy array
+    '''
+    arr = read_rst(image)
+    if arr is not None:
+        return arr
+    in_ds = open_dataset(image)
+    return in_ds.GetRasterBand(1).ReadAsArray()
+
+def block_windows(x_size, y_size, block_y_size=1, block_pixels=BLOCK_PIXELS):
+    '''
+    Split a raster into full-width row strips aligned to the native block height
+    :param x_size: number of columns
+    :param y_size: number of rows
+    :param block_y_size: native block height of the raster
+    :param block_pixels: approximate number of pixels per strip
+    :return: generator of windows (xoff, yoff, xsize, ysize)
+    '''
+    block_y_size = max(int(block_y_size), 1)
+    # Use as many native block rows as fit in block_pixels, but at least one
+    rows = max(block_pixels // max(x_size, 1) // block_y_size, 1) * block_y_size
+    for yoff in range(0, y_size, rows):
+        yield (0, yoff, x_size, min(rows, y_size - yoff))
+
+def tile_windows(x_size, y_size, tile_size):
+    '''
+    Split a raster into square tiles
+    :param x_size: number of columns
+    :param y_size: number of rows
+    :param tile_size: number of rows and columns per tile
+    :return: generator of windows (xoff, yoff, xsize, ysize)
+    '''
+    for yoff in range(0, y_size, tile_size):
+        for xoff in range(0, x_size, tile_size):
+            yield (xoff, yoff, min(tile_size, x_size - xoff), min(tile_size, y_size - yoff))
+
+def halo_window(window, halo, x_size, y_size):
+    '''
+    Grow a window by a halo of pixels on each side, clipped to the raster
+    :param window: (xoff, yoff, xsize, ysize)
+    :param halo: number of pixels added on each side
+    :param x_size: number of columns of the raster
+    :param y_size: number of rows of the raster
+    :return: outer_window: (xoff, yoff, xsize, ysize) of the grown window,
+             core: slices of the original window within the grown window
+    '''
+    xoff, yoff, xsize, ysize = window
+    x0 = max(xoff - halo, 0)
+    y0 = max(yoff - halo, 0)
+    x1 = min(xoff + xsize + halo, x_size)
+    y1 = min(yoff + ysize + halo, y_size)
+    core = (slice(yoff - y0, yoff - y0 + ysize), slice(xoff - x0, xoff - x0 + xsize))
+    return (x0, y0, x1 - x0, y1 - y0), core
+
+def read_window(image, window):
+    '''
+    Read one window of a raster
+    :param image: raster path
+    :param window: (xoff, yoff, xsize, ysize)
+    :return: NumPy array of shape (ysize, xsize)
+    '''
+    xoff, yoff, xsize, ysize = window
+    arr = read_rst(image)
+    if arr is not None:
+        return np.asarray(arr[yoff:yoff + ysize, xoff:xoff + xsize])
+    return open_dataset(image).GetRasterBand(1).ReadAsArray(*window)
+
+def python_executable():
+    '''
+    Python interpreter of the running installation, used to spawn worker processes
+    Inside QGIS sys.executable is the QGIS binary, the interpreter is looked up under sys.exec_prefix instead.
+    :return: path of the interpreter, None if it can not be found
+    '''
+    version = f'{sys.version_info.major}.{sys.version_info.minor}'
+    if sys.platform == 'win32':
+        names = ['pythonw.exe', 'python.exe']
+    else:
+        names = [os.path.join('bin', f'python{version}'), os.path.join('bin', 'python3'), os.path.join('bin', 'python')]
+    for name in names:
+        python_exe = os.path.join(sys.exec_prefix, name)
+        if os.path.isfile(python_exe):
+            return python_exe
+    return None
+
+def process_pool(workers=None):
+    '''
+    Process pool for CPU-bound raster stages
+    Worker processes are spawned, not forked from the QGIS process, and run the Python interpreter of the
+    installation (see python_executable) instead of the QGIS executable. Callers run the tasks in-process
+    when python_executable() is None.
+    Tasks must be module-level functions that open their own datasets.
+    :param workers: number of processes, all CPUs by default
+    :return: concurrent.futures.ProcessPoolExecutor
+    '''
+    python_exe = python_executable()
+    if python_exe is None:
+        raise RuntimeError("No Python interpreter found under sys.exec_prefix to run the worker processes")
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(python_exe)
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context)
+
+def iter_blocks(*images, block_pixels=BLOCK_PIXELS):
+    '''
+    Read several co-registered rasters window by window
+    :param images: paths of rasters with the same number of rows and columns
+    :param block_pixels: approximate number of pixels per window
+    :return: generator of (window, arrays), window is (xoff, yoff, xsize, ysize)
+             and arrays holds one array per input image
+    '''
+    datasets = [open_dataset(image) for image in images]
+    bands = [in_ds.GetRasterBand(1) for in_ds in datasets]
+    # TerrSet binary rasters are sliced from a memory map instead of read through GDAL
+    mapped = [read_rst(image) for image in images]
+    x_size = datasets[0].RasterXSize
+    y_size = datasets[0].RasterYSize
+    for in_ds, image in zip(datasets, images):
+        if (in_ds.RasterXSize, in_ds.RasterYSize) != (x_size, y_size):
+            raise ValueError(f"{image} does not have the same number of rows and columns as {images[0]}")
+
+    # Follow the native block layout of the first input
+    _, block_y_size = bands[0].GetBlockSize()
+    for window in block_windows(x_size, y_size, block_y_size, block_pixels):
+        xoff, yoff, xsize, ysize = window
+        yield window, [np.asarray(arr[yoff:yoff + ysize, xoff:xoff + xsize]) if arr is not None
+                       else band.ReadAsArray(*window) for arr, band in zip(mapped, bands)]
+
+def iter_array_blocks(*arrays, block_pixels=BLOCK_PIXELS):
+    '''
+    Split several in-memory arrays of the same shape into the row strips of iter_blocks
+    :param arrays: 2D NumPy arrays
+    :param block_pixels: approximate number of pixels per window
+    :return: generator of (window, arrays), the arrays are views of the input arrays
+    '''
+    y_size, x_size = arrays[0].shape
+    for window in block_windows(x_size, y_size, 1, block_pixels):
+        xoff, yoff, xsize, ysize = window
+        yield window, [arr[yoff:yoff + ysize, xoff:xoff + xsize] for arr in arrays]
+
+def map_blocks(function, blocks, workers=None, max_bytes=IN_FLIGHT_BYTES):
+    '''
+    Apply a function to row strips on a thread pool
+    NumPy releases the GIL in ufuncs, sorting and indexing, so strips are processed on several cores.
+    The blocks are read on the calling thread and results are returned in order, each strip is computed
+    exactly as in a single-threaded run. At most 2 * workers strips are in flight, and no more than max_bytes
+    of input arrays, so memory does not grow with the number of CPUs; a single strip is always allowed.
+    :param function: function(*arrays) -> result of one strip
+    :param blocks: iterable of (window, arrays), e.g. iter_blocks or iter_array_blocks
+    :param workers: number of threads, all CPUs by default, 1 runs on the calling thread
+    :param max_bytes: maximum size of the input arrays in flight
+    :return: generator of (window, result)
+    '''
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        for window, arrays in blocks:
+            yield window, function(*arrays)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        in_flight_bytes = 0
+        for window, arrays in blocks:
+            strip_bytes = sum(array.nbytes for array in arrays)
+            # Wait for the oldest strips until the new one fits into the budget
+            while pending and (len(pending) >= 2 * workers or in_flight_bytes + strip_bytes > max_bytes):
+                done_window, future, done_bytes = pending.popleft()
+                in_flight_bytes -= done_bytes
+                yield done_window, future.result()
+            pending.append((window, pool.submit(function, *arrays), strip_bytes))
+            in_flight_bytes += strip_bytes
+        while pending:
+            window, future, _ = pending.popleft()
+            yield window, future.result()
+
+def driver_name(out_fn):
+    '''
+    GDAL driver of an output raster from its file extension
+    :param out_fn: output path (.tif or .rst)
+    :return: driver name
+    '''
+    output_format = out_fn.split('.')[-1].upper()
+    if (output_format == 'TIF'):
+        output_format = 'GTIFF'
+    elif (output_format == 'RST'):
+        output_format = 'rst'
+    return output_format
+
+def fix_ref_system(in_fn, out_fn):
+    '''
+     RST raster format: correct reference system name in rdc file
+     :param in_fn: datasource to copy correct projection name
+     :param out_fn: rst raster file
+     :return: True if the rdc file was corrected
+    '''
+    if out_fn.split('.')[-1] != 'rst':
+        return False
+    read_file_name, _ = os.path.splitext(in_fn)
+    write_file_name, _ = os.path.splitext(out_fn)
+
+    correct_name = None
+    with open(read_file_name + '.rdc', 'r') as read_file:
+        for line in read_file:
+            if line.startswith("ref. system :"):
+                correct_name = line
+                break
+
+    if not correct_name:
+        return False
+    # Unique temp file next to the output, fix-ups of several outputs may run at the same time
+    with open(write_file_name + '.rdc', 'r') as read_file, \
+            tempfile.NamedTemporaryFile('w', suffix='.rdc', dir=os.path.dirname(os.path.abspath(out_fn)),
+                                        delete=False) as write_file:
+        temp_file_path = write_file.name
+        for line in read_file:
+            if line.startswith("ref. system :"):
+                write_file.write(correct_name)
+            else:
+                write_file.write(line)
+
+    # Move the temp file to replace the original
+    shutil.move(temp_file_path, write_file_name + '.rdc')
+    evict(out_fn)
+    return True
+
+def overview_resampling(data_type):
+    '''
+    Overview resampling of an output: nearest neighbour for classes and ids, average for densities
+    :param data_type: output data type
+    :return: GDAL resampling name
+    '''
+    return 'AVERAGE' if data_type in FLOAT_DATA_TYPES else 'NEAREST'
+
+def overview_levels(x_size, y_size):
+    '''
+    Overview decimation factors down to MIN_OVERVIEW_SIZE pixels
+    :return: list of factors (2, 4, 8, ...)
+    '''
+    levels = []
+    factor = 2
+    while min(x_size, y_size) // factor >= MIN_OVERVIEW_SIZE:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+def build_overviews(out_fn, data_type):
+    '''
+    Convert a finished GeoTIFF to a Cloud-Optimized GeoTIFF, or build overviews in place when the COG driver is
+    not available (GDAL < 3.1) and for other formats (external .ovr overviews for RST outputs)
+    The COG is written to a temporary file that replaces the output only once it is complete, the output is left
+    untouched if the conversion fails. Overviews are computed with all CPUs.
+    :param out_fn: output raster, closed
+    :param data_type: output data type, selects the resampling
+    '''
+    resampling = overview_resampling(data_type)
+    evict(out_fn)
+    previous_threads = gdal.GetConfigOption('GDAL_NUM_THREADS')
+    gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    try:
+        if driver_name(out_fn) == 'GTIFF' and gdal.GetDriverByName('COG') is not None:
+            temp_fn = os.path.splitext(out_fn)[0] + '.cog.tmp.tif'
+            try:
+                # The returned dataset is released at once, which closes the COG before it is moved
+                gdal.Translate(temp_fn, out_fn, format='COG',
+                               creationOptions=COG_OPTIONS + [f'OVERVIEW_RESAMPLING={resampling}'])
+                os.replace(temp_fn, out_fn)
+            except Exception:
+                if os.path.exists(temp_fn):
+                    gdal.GetDriverByName('GTiff').Delete(temp_fn)
+                raise
+        else:
+            # Internal overviews in a GeoTIFF, external .ovr overviews for the other formats
+            access = gdal.GA_Update if driver_name(out_fn) == 'GTIFF' else gdal.GA_ReadOnly
+            out_ds = gdal.Open(out_fn, access)
+            out_ds.BuildOverviews(resampling, overview_levels(out_ds.RasterXSize, out_ds.RasterYSize))
+            out_ds = None
+    finally:
+        gdal.SetConfigOption('GDAL_NUM_THREADS', previous_threads)
+
+class WriteProfileMixin:
+    '''
+    GeoTIFF write profile of the outputs of a processing engine, DEFAULT_WRITE_PROFILE until set
+    '''
+    write_profile = DEFAULT_WRITE_PROFILE
+
+    def set_write_profile(self, profile):
+        '''
+        Set up the GeoTIFF write profile of the outputs
+        :param profile: name in WRITE_PROFILES ('striped', 'deflate', 'zstd', 'lzw', 'cog')
+                        or a dictionary of GeoTIFF creation options
+        '''
+        self.write_profile = profile
+
+class BackgroundWriter:
+    '''
+    Run write jobs in order on a background thread, so the next blocks are computed while outputs flush
+    GDAL releases the GIL during I/O. The queue is bounded, submit blocks while max_pending jobs are
+    waiting, which caps the number of finished blocks held in memory. The first error raised by a job
+    is raised again by wait() and close(), and later jobs are skipped.
+
+        with BackgroundWriter() as writer:
+            writer.submit(out_band.WriteArray, arr, xoff, yoff)
+            ...  # keep computing
+    '''
+    def __init__(self, max_pending=2):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='BackgroundWriter', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs = job
+                if self.error is None:
+                    func(*args, **kwargs)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Queue a write job, jobs run in submission order
+        :param func: callable writing an output, e.g. the WriteArray of a band
+        '''
+        if self.thread is None:
+            raise RuntimeError("BackgroundWriter is closed")
+        self._raise_error()
+        self.jobs.put((func, args, kwargs))
+
+    def wait(self):
+        '''
+        Block until all queued jobs are written, raise the first write error
+        '''
+        self.jobs.join()
+        self._raise_error()
+
+    def close(self):
+        '''
+        Write the remaining jobs and stop the thread, raise the first write error
+        '''
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep the original exception, a write error would only hide it
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
+
+class RasterWriter:
+    '''
+    Write an output raster window by window
+    Projection and geotransform are copied from in_fn. Once the writer is closed, the reference system
+    name in the rdc file of RST outputs is corrected from ref_fn and, with the 'cog' profile, overviews are built.
+    With background=True the windows are written on a BackgroundWriter thread while the caller computes the
+    next ones, at most two windows wait in its queue.
+
+        with RasterWriter(in_fn, out_fn, gdal.GDT_Byte) as writer:
+            for window, (arr,) in iter_blocks(in_fn):
+                writer.write(window, arr)
+    '''
+    def __init__(self, in_fn, out_fn, data_type, nodata=None, profile=DEFAULT_WRITE_PROFILE, ref_fn=None,
+                 background=False):
+        '''
+        :param in_fn: datasource to copy projection and geotransform from
+        :param out_fn: path to the file to create
+        :param data_type: output data type
+        :param nodata: optional NoData value
+        :param profile: write profile, see creation_options
+        :param ref_fn: datasource to copy the RST reference system name from, in_fn by default
+        :param background: write the windows on a background thread, the arrays passed to write must not be
+                           modified afterwards
+        '''
+        self.in_fn = in_fn
+        self.out_fn = out_fn
+        self.data_type = data_type
+        self.profile = profile
+        self.ref_fn = in_fn if ref_fn is None else ref_fn
+        in_info = raster_info(in_fn)
+        evict(out_fn)
+        output_format = driver_name(out_fn)
+        driver = gdal.GetDriverByName(output_format)
+        self.out_ds = driver.Create(out_fn, in_info.x_size, in_info.y_size, 1, data_type,
+                                    options=creation_options(output_format, data_type, profile))
+        self.out_ds.SetProjection(in_info.projection.encode('utf-8', 'backslashreplace').decode('utf-8'))
+        self.out_ds.SetGeoTransform(in_info.geotransform)
+        self.out_band = self.out_ds.GetRasterBand(1)
+        if nodata is not None:
+            self.out_band.SetNoDataValue(nodata)
+        self.background = BackgroundWriter() if background else None
+
+    def write(self, window, data):
+        '''
+        Write one window
+        :param window: (xoff, yoff, xsize, ysize) as produced by iter_blocks
+        :param data: NumPy array of shape (ysize, xsize)
+        '''
+        if self.background is not None:
+            self.background.submit(self.out_band.WriteArray, data, window[0], window[1])
+        else:
+            self.out_band.WriteArray(data, window[0], window[1])
+
+    def close(self):
+        '''
+        Flush the output to disk and correct the RST reference system
+        '''
+        if self.out_ds is None:
+            return
+        try:
+            if self.background is not None:
+                # Write the queued windows, raise the first write error
+                self.background.close()
+            self.out_band.FlushCache()
+            self.out_ds.FlushCache()
+        finally:
+            self.out_band = None
+            self.out_ds = None
+        ref_rdc = os.path.splitext(self.ref_fn)[0] + '.rdc'
+        if os.path.exists(ref_rdc):
+            fix_ref_system(self.ref_fn, self.out_fn)
+        if self.profile == 'cog':
+            build_overviews(self.out_fn, self.data_type)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Release the dataset, the partial output is left as is
+            if self.background is not None:
+                try:
+                    self.background.close()
+                except Exception:
+                    pass
+            self.out_band = None
+            self.out_ds = None
+        return False
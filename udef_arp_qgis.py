@@ -52,8 +52,9 @@ from qgis.gui import QgsMapLayerComboBox
 # Custom imports
 from .resources import *
 from .allocation_tool import AllocationTool
-from .vulnerability_map import VulnerabilityMap
+from .vulnerability_map import VulnerabilityMap, NRT_SWEEP_PERCENTILES, NRT_SWEEP_BIN_MULTIPLES, CLASSIFICATION_METHODS
 from .model_evaluation import ModelEvaluation
+from .raster_io import iter_blocks, open_dataset, raster_info, DEFAULT_WRITE_PROFILE
 
 # GDAL exceptions
 gdal.UseExceptions()
@@ -84,6 +85,28 @@ style_sheet = """
     selection-background-color: #add8e6;
 """
 
+def apply_write_profile(engine, add_to_map_check_box):
+    '''
+    Set the write profile of a processing engine from the "add to map" check box of a screen,
+    outputs added to the map are written as Cloud-Optimized GeoTIFFs with overviews
+    :param engine: VulnerabilityMap, AllocationTool or ModelEvaluation
+    :param add_to_map_check_box: check box adding the outputs to the map
+    '''
+    engine.set_write_profile('cog' if add_to_map_check_box.isChecked() else DEFAULT_WRITE_PROFILE)
+
+def show_processing_completed(parent, run_summary):
+    '''
+    Processing completed message of the prediction screens
+    :param parent: screen showing the message
+    :param run_summary: PredictionRunSummary of the run, its modeled deforestation is shown against the target
+    '''
+    if run_summary is None or run_summary.achieved_deforestation is None:
+        QMessageBox.information(parent, "Processing Completed", "Processing completed!")
+    else:
+        QMessageBox.information(parent, "Processing Completed", f"Processing completed!\n"
+                                f"Modeled deforestation: {run_summary.achieved_deforestation:.2f} ha "
+                                f"(target: {run_summary.target_deforestation:.2f} ha)")
+
 ######################################################################################################
 
 class IntroScreen(QtWidgets.QDialog, FORM_CLASS0):
@@ -349,7 +372,17 @@ class RMT_FIT_CAL_SCREEN(QtWidgets.QDialog, FORM_CLASS1):
             # Update the central data store
             central_data_store.NRT = NRT
 
-            QMessageBox.information(self, "Processing Completed", f"Processing completed!\nNRT is: {NRT}")
+            # Sensitivity of the NRT to the cumulative proportion and bin width, from the cached distance histogram
+            nrt_table = self.vulnerability_map.nrt_sweep(self.in_fn, self.deforestation_hrp, self.mask,
+                                                         NRT_SWEEP_PERCENTILES, NRT_SWEEP_BIN_MULTIPLES)
+            sweep_lines = ["Bin width (x resolution): " + ", ".join(f"{p:g}" for p in NRT_SWEEP_PERCENTILES)]
+            for bin_multiple in NRT_SWEEP_BIN_MULTIPLES:
+                sweep_lines.append(f"{bin_multiple}: " + ", ".join(str(nrt_table[(p, bin_multiple)])
+                                                                   for p in NRT_SWEEP_PERCENTILES))
+            sweep_text = "\n".join(sweep_lines)
+
+            QMessageBox.information(self, "Processing Completed", f"Processing completed!\nNRT is: {NRT}"
+                                                                  f"\n\nNRT by cumulative proportion:\n{sweep_text}")
 
             self.nrt_entry.setText(str(NRT))
 
@@ -425,10 +458,9 @@ class RMT_FIT_CAL_SCREEN(QtWidgets.QDialog, FORM_CLASS1):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.vulnerability_map, self.checkBox)
             self.vulnerability_map.set_working_directory(directory)
-            mask_arr = self.vulnerability_map.geometric_classification(self.in_fn, NRT, n_classes)
-            self.vulnerability_map.array_to_image(self.in_fn, out_fn, mask_arr, gdal.GDT_Int16, -1)
-            self.vulnerability_map.replace_ref_system(self.in_fn, out_fn)
+            self.vulnerability_map.classify_batch([(self.in_fn, NRT, n_classes, out_fn)])
 
             if self.checkBox.isChecked():
                 basename = os.path.splitext(os.path.basename(out_fn))[0]
@@ -517,10 +549,12 @@ class RMT_FIT_CAL_SCREEN(QtWidgets.QDialog, FORM_CLASS1):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.vulnerability_map, self.checkBox_2)
             self.vulnerability_map.set_working_directory(directory_2)
-            mask_arr = self.vulnerability_map.geometric_classification_alternative(self.in_fn_2, n_classes_2, self.mask_2, self.fmask_2)
-            self.vulnerability_map.array_to_image(self.in_fn_2, out_fn_2, mask_arr, gdal.GDT_Int16, -1)
-            self.vulnerability_map.replace_ref_system(self.in_fn_2, out_fn_2)
+            # Geometric or equal-area classes, in the order of the method combo box
+            method_2 = CLASSIFICATION_METHODS[self.method_entry_2.currentIndex()]
+            self.vulnerability_map.classify_batch([(self.in_fn_2, None, n_classes_2, out_fn_2)], self.mask_2, self.fmask_2,
+                                                  method_2)
 
             if self.checkBox_2.isChecked():
                 basename = os.path.splitext(os.path.basename(out_fn_2))[0]
@@ -723,6 +757,7 @@ class AT_FIT_CAL_SCREEN(QtWidgets.QDialog, FORM_CLASS2):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.allocation_tool, self.checkBox)
             self.allocation_tool.execute_workflow_fit(directory, self.risk30_hrp,
                                                         self.municipality,self.deforestation_hrp, csv_name,
                                                         out_fn1,out_fn2)
@@ -972,6 +1007,7 @@ class MCT_FIT_CAL_SCREEN(QtWidgets.QDialog, FORM_CLASS3):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.model_evaluation, self.checkBox)
             self.model_evaluation.set_working_directory(directory)
             self.model_evaluation.create_mask_polygon(self.mask)
             clipped_gdf = self.model_evaluation.create_thiessen_polygon(self.grid_area, self.mask,self.density, self.deforestation_hrp, out_fn,raster_fn)
@@ -1200,10 +1236,9 @@ class RMT_PRE_CNF_SCREEN(QtWidgets.QDialog, FORM_CLASS4):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.vulnerability_map, self.checkBox)
             self.vulnerability_map.set_working_directory(directory)
-            mask_arr = self.vulnerability_map.geometric_classification(self.in_fn, NRT, n_classes)
-            self.vulnerability_map.array_to_image(self.in_fn, out_fn, mask_arr, gdal.GDT_Int16, -1)
-            self.vulnerability_map.replace_ref_system(self.in_fn, out_fn)
+            self.vulnerability_map.classify_batch([(self.in_fn, NRT, n_classes, out_fn)])
 
             if self.checkBox.isChecked():
                 basename = os.path.splitext(os.path.basename(out_fn))[0]
@@ -1290,11 +1325,12 @@ class RMT_PRE_CNF_SCREEN(QtWidgets.QDialog, FORM_CLASS4):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.vulnerability_map, self.checkBox_2)
             self.vulnerability_map.set_working_directory(directory_2)
-            mask_arr = self.vulnerability_map.geometric_classification_alternative(self.in_fn_2, n_classes_2,
-                                                                                   self.mask_2, self.fmask_2)
-            self.vulnerability_map.array_to_image(self.in_fn_2, out_fn_2, mask_arr, gdal.GDT_Int16, -1)
-            self.vulnerability_map.replace_ref_system(self.in_fn_2, out_fn_2)
+            # Geometric or equal-area classes, in the order of the method combo box
+            method_2 = CLASSIFICATION_METHODS[self.method_entry_2.currentIndex()]
+            self.vulnerability_map.classify_batch([(self.in_fn_2, None, n_classes_2, out_fn_2)], self.mask_2, self.fmask_2,
+                                                  method_2)
 
             if self.checkBox_2.isChecked():
                 basename = os.path.splitext(os.path.basename(out_fn_2))[0]
@@ -1502,6 +1538,7 @@ class AT_PRE_CNF_SCREEN(QtWidgets.QDialog, FORM_CLASS5):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.allocation_tool, self.checkBox)
             id_difference = self.allocation_tool.execute_workflow_cnf(directory,
                                                             self.max_iterations, self.csv,
                                                             self.municipality,
@@ -1520,7 +1557,7 @@ class AT_PRE_CNF_SCREEN(QtWidgets.QDialog, FORM_CLASS5):
                 
             if id_difference.size > 0:
                 QMessageBox.warning(self, " Warning ", f"Modeling Region ID {','.join(map(str, id_difference))} do not exist in the Calculation Period. A new CSV has been created for the CAL where relative frequencies for missing bins have been estimated from corresponding vulnerability zones over the entire jurisdiction.")
-            QMessageBox.information(self, "Processing Completed", "Processing completed!")
+            show_processing_completed(self, self.allocation_tool.run_summary)
             self.progressDialog.close()
 
         except Exception as e:
@@ -1788,6 +1825,7 @@ class MCT_PRE_CNF_SCREEN(QtWidgets.QDialog, FORM_CLASS6):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.model_evaluation, self.checkBox)
             self.model_evaluation.set_working_directory(directory)
             self.model_evaluation.create_mask_polygon(self.mask)
             clipped_gdf = self.model_evaluation.create_thiessen_polygon(self.grid_area, self.mask, self.density,
@@ -1795,7 +1833,6 @@ class MCT_PRE_CNF_SCREEN(QtWidgets.QDialog, FORM_CLASS6):
             self.model_evaluation.replace_ref_system(self.mask, raster_fn)
             self.model_evaluation.create_deforestation_map(self.fmask, self.deforestation_cal, self.deforestation_hrp,
                                                            out_fn_def)
-            self.model_evaluation.replace_ref_system(self.fmask, out_fn_def)
             self.model_evaluation.replace_legend(out_fn_def)
             self.model_evaluation.create_plot(grid_area,clipped_gdf, title, out_fn, xmax, ymax)
             self.model_evaluation.remove_temp_files()
@@ -2017,10 +2054,9 @@ class RMT_FIT_HRP_SCREEN(QtWidgets.QDialog, FORM_CLASS7):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.vulnerability_map, self.checkBox)
             self.vulnerability_map.set_working_directory(directory)
-            mask_arr = self.vulnerability_map.geometric_classification(self.in_fn, NRT, n_classes)
-            self.vulnerability_map.array_to_image(self.in_fn, out_fn, mask_arr, gdal.GDT_Int16, -1)
-            self.vulnerability_map.replace_ref_system(self.in_fn, out_fn)
+            self.vulnerability_map.classify_batch([(self.in_fn, NRT, n_classes, out_fn)])
 
             if self.checkBox.isChecked():
                 basename = os.path.splitext(os.path.basename(out_fn))[0]
@@ -2107,11 +2143,12 @@ class RMT_FIT_HRP_SCREEN(QtWidgets.QDialog, FORM_CLASS7):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.vulnerability_map, self.checkBox_2)
             self.vulnerability_map.set_working_directory(directory_2)
-            mask_arr = self.vulnerability_map.geometric_classification_alternative(self.in_fn_2, n_classes_2,
-                                                                                   self.mask_2, self.fmask_2)
-            self.vulnerability_map.array_to_image(self.in_fn_2, out_fn_2, mask_arr, gdal.GDT_Int16, -1)
-            self.vulnerability_map.replace_ref_system(self.in_fn_2, out_fn_2)
+            # Geometric or equal-area classes, in the order of the method combo box
+            method_2 = CLASSIFICATION_METHODS[self.method_entry_2.currentIndex()]
+            self.vulnerability_map.classify_batch([(self.in_fn_2, None, n_classes_2, out_fn_2)], self.mask_2, self.fmask_2,
+                                                  method_2)
 
             if self.checkBox_2.isChecked():
                 basename = os.path.splitext(os.path.basename(out_fn_2))[0]
@@ -2304,6 +2341,7 @@ class AT_FIT_HRP_SCREEN(QtWidgets.QDialog, FORM_CLASS8):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.allocation_tool, self.checkBox)
             self.allocation_tool.execute_workflow_fit(directory, self.risk30_hrp,
                                                         self.municipality,self.deforestation_hrp, csv_name,
                                                         out_fn1,out_fn2)
@@ -2525,10 +2563,9 @@ class RMT_PRE_VP_SCREEN(QtWidgets.QDialog, FORM_CLASS9):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.vulnerability_map, self.checkBox)
             self.vulnerability_map.set_working_directory(directory)
-            mask_arr = self.vulnerability_map.geometric_classification(self.in_fn, NRT, n_classes)
-            self.vulnerability_map.array_to_image(self.in_fn, out_fn, mask_arr, gdal.GDT_Int16, -1)
-            self.vulnerability_map.replace_ref_system(self.in_fn, out_fn)
+            self.vulnerability_map.classify_batch([(self.in_fn, NRT, n_classes, out_fn)])
 
             if self.checkBox.isChecked():
                 basename = os.path.splitext(os.path.basename(out_fn))[0]
@@ -2615,11 +2652,12 @@ class RMT_PRE_VP_SCREEN(QtWidgets.QDialog, FORM_CLASS9):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.vulnerability_map, self.checkBox_2)
             self.vulnerability_map.set_working_directory(directory_2)
-            mask_arr = self.vulnerability_map.geometric_classification_alternative(self.in_fn_2, n_classes_2,
-                                                                                   self.mask_2, self.fmask_2)
-            self.vulnerability_map.array_to_image(self.in_fn_2, out_fn_2, mask_arr, gdal.GDT_Int16, -1)
-            self.vulnerability_map.replace_ref_system(self.in_fn_2, out_fn_2)
+            # Geometric or equal-area classes, in the order of the method combo box
+            method_2 = CLASSIFICATION_METHODS[self.method_entry_2.currentIndex()]
+            self.vulnerability_map.classify_batch([(self.in_fn_2, None, n_classes_2, out_fn_2)], self.mask_2, self.fmask_2,
+                                                  method_2)
 
             if self.checkBox_2.isChecked():
                 basename = os.path.splitext(os.path.basename(out_fn_2))[0]
@@ -2829,6 +2867,7 @@ class AT_PRE_VP_SCREEN(QtWidgets.QDialog, FORM_CLASS10):
         QApplication.processEvents()
 
         try:
+            apply_write_profile(self.allocation_tool, self.checkBox)
             id_difference = self.allocation_tool.execute_workflow_vp(directory, self.max_iterations,
                                                                            self.csv,
                                                                            self.municipality,
@@ -2849,7 +2888,7 @@ class AT_PRE_VP_SCREEN(QtWidgets.QDialog, FORM_CLASS10):
             if id_difference.size > 0:
                 QMessageBox.warning(self, " Warning ", f"Modeling Region ID {','.join(map(str, id_difference))} do not exist in the Historical Reference Period. A new CSV has been created for the HRP where relative frequencies for missing bins have been estimated from corresponding vulnerability zones over the entire jurisdiction.")
 
-            QMessageBox.information(self, "Processing Completed", "Processing completed!")
+            show_processing_completed(self, self.allocation_tool.run_summary)
             self.progressDialog.close()
 
         except Exception as e:
@@ -3047,36 +3086,25 @@ class MapChecker:
         self.in_fn=None
 
     def get_image_resolution(self,image):
-        in_ds = gdal.Open(image)
-        P = in_ds.GetGeoTransform()[1]
+        P = raster_info(image).geotransform[1]
         return P
 
     def get_image_dimensions(self, image):
-        dataset = gdal.Open(image)
-        cols = dataset.RasterXSize
-        rows = dataset.RasterYSize
+        info = raster_info(image)
+        cols = info.x_size
+        rows = info.y_size
         return rows, cols
 
     def get_image_datatype(self, image):
-        in_ds = gdal.Open(image)
-        in_band = in_ds.GetRasterBand(1)
-        datatype = gdal.GetDataTypeName(in_band.DataType)
+        datatype = gdal.GetDataTypeName(raster_info(image).data_type)
         return datatype
 
     def get_image_max_min(self, image):
-        in_ds = gdal.Open(image)
+        in_ds = open_dataset(image)
         in_band = in_ds.GetRasterBand(1)
         min, max= in_band.ComputeRasterMinMax()
         return min, max
 
-    def find_unique_values(self, arr, limit=2):
-        unique_values = set()
-        for value in np.nditer(arr):
-            unique_values.add(value.item())
-            if len(unique_values) > limit:
-                return False
-        return True
-
     def check_binary_map(self, in_fn):
         '''
         Check if input image is binary map
@@ -3099,14 +3127,15 @@ class MapChecker:
             float_binary = datatype in ['Float32', 'Float64', 'CFloat32', 'CFloat64'] and max_val == 1.0000000 and min_val == 0.0000000
 
         if byte_or_integer_binary or (float_binary):
-            # For float_binary, use find_unique_values function to check if data only have two unique values [0.0000000, 1.0000000].
+            # For float_binary, check if data only have two unique values [0.0000000, 1.0000000].
             if float_binary:
-                in_ds = gdal.Open(in_fn)
-                in_band = in_ds.GetRasterBand(1)
-                arr = in_band.ReadAsArray()
-                # If more than two unique values are found, it's not a binary map, return False.
-                if not self.find_unique_values(arr, 2):
-                    return False
+                # Read the image block by block and stop at the first block with a third value.
+                unique_values = set()
+                for _, (arr,) in iter_blocks(in_fn):
+                    unique_values.update(np.unique(arr).tolist())
+                    # If more than two unique values are found, it's not a binary map, return False.
+                    if len(unique_values) > 2:
+                        return False
             # Binary map: byte_or_integer_binary or float_binary with two unique values [0.0000000, 1.0000000], it returns True.
             return True
         # For any other scenario, it returns False.
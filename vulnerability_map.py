@@ -1,18 +1,93 @@
 import os
+import math
+from contextlib import ExitStack
+from concurrent.futures import wait, FIRST_COMPLETED
 import numpy as np
 from osgeo import gdal
+from scipy import ndimage
 from PyQt5.QtCore import QObject, pyqtSignal
-import shutil
+from .raster_io import (iter_blocks, map_blocks, read_array, read_window, open_dataset, raster_info, file_key,
+                        tile_windows, halo_window, process_pool, python_executable, WriteProfileMixin, RasterWriter,
+                        fix_ref_system, minimal_integer_type, releases_datasets)
+
+# Cumulative proportion of the deforestation within the NRT
+NRT_PERCENTILE = 0.995
+# Cumulative proportions and bin widths (multiples of the spatial resolution) of the NRT sensitivity table
+NRT_SWEEP_PERCENTILES = (0.99, 0.995, 0.999)
+NRT_SWEEP_BIN_MULTIPLES = (1, 2, 4)
+
+# Classification methods of the empirical vulnerability maps, in the order of the method box of the screens
+CLASSIFICATION_METHODS = ('geometric', 'equal_area')
+
+# Number of bins of the histogram sketch of the equal-area classification, the bins holding a class break
+# are split again in QUANTILE_SKETCH_BINS bins so the breaks are exact to max / QUANTILE_SKETCH_BINS ** 2
+QUANTILE_SKETCH_BINS = 4096
 
 # GDAL exceptions
 gdal.UseExceptions()
 
-class VulnerabilityMap(QObject):
+# Number of rows and columns of the tiles of the distance transform, without the halo
+EDT_TILE_SIZE = 2048
+
+def edge_distance_tile(fmask, window, max_distance):
+    '''
+    Distance from the forest edge within one tile, run in a worker process
+    The tile is read with a halo of max_distance so the distances up to max_distance are exact
+    :param fmask: mask of the forest areas (binary map)
+    :param window: (xoff, yoff, xsize, ysize) of the tile
+    :param max_distance: distances are capped at max_distance (map units)
+    :return: window, distance array of the tile (float32, 0 in non-forest)
+    '''
+    in_info = raster_info(fmask)
+    sampling = (abs(in_info.geotransform[5]), abs(in_info.geotransform[1]))
+    halo = int(math.ceil(max_distance / min(sampling)))
+    outer_window, core = halo_window(window, halo, in_info.x_size, in_info.y_size)
+    forest = read_window(fmask, outer_window) == 1
+
+    # No non-forest pixel within max_distance of the tile
+    if forest.all():
+        return window, np.full((window[3], window[2]), max_distance, dtype=np.float32)
+
+    # Euclidean distance of each forest pixel to the nearest non-forest pixel
+    distance = ndimage.distance_transform_edt(forest, sampling=sampling)[core]
+    return window, np.minimum(distance, max_distance).astype(np.float32)
+
+def updated_edge_distance_tile(distance_fn, change_fn, window, max_distance):
+    '''
+    Update the distance from the forest edge of one tile after new deforestation, run in a worker process
+    New non-forest pixels only shorten distances, the new distance is the minimum of the previous distance
+    and the distance to the nearest changed pixel within max_distance of the tile
+    :param distance_fn: previous map of distance from the forest edge
+    :param change_fn: binary map of the new deforestation (1 = forest lost since the previous map)
+    :param window: (xoff, yoff, xsize, ysize) of the tile
+    :param max_distance: distances are capped at max_distance (map units)
+    :return: window, distance array of the tile (float32, 0 in non-forest)
+    '''
+    in_info = raster_info(change_fn)
+    sampling = (abs(in_info.geotransform[5]), abs(in_info.geotransform[1]))
+    halo = int(math.ceil(max_distance / min(sampling)))
+    outer_window, core = halo_window(window, halo, in_info.x_size, in_info.y_size)
+    unchanged = read_window(change_fn, outer_window) != 1
+    distance = np.minimum(read_window(distance_fn, window), max_distance).astype(np.float32)
+
+    # No new deforestation within max_distance of the tile, keep the previous distances
+    if unchanged.all():
+        return window, distance
+
+    # Euclidean distance of each pixel to the nearest new non-forest pixel
+    change_distance = ndimage.distance_transform_edt(unchanged, sampling=sampling)[core]
+    return window, np.minimum(distance, change_distance).astype(np.float32)
+
+class VulnerabilityMap(QObject, WriteProfileMixin):
     progress_updated = pyqtSignal(int)
     def __init__(self):
         super(VulnerabilityMap, self).__init__()
         self.data_folder = None
+        # Number of threads of the block processing, all CPUs by default
+        self.workers = None
         self.initial_directory = None
+        # Distance histograms of the NRT calculation, keyed by the input files
+        self.distance_histograms = {}
 
     def set_working_directory(self, directory):
         '''
@@ -23,52 +98,176 @@ class VulnerabilityMap(QObject):
         self.data_folder = directory
         os.chdir(self.data_folder)
 
+    def set_workers(self, workers):
+        '''
+        Set up the number of threads used to process the raster blocks
+        :param workers: number of threads, None for all CPUs, 1 to process on the calling thread
+        '''
+        self.workers = workers
+
     def image_to_array(self,image):
-        # Set up a GDAL dataset
-        in_ds = gdal.Open(image)
-        # Set up a GDAL band
-        in_band = in_ds.GetRasterBand(1)
-        # Create Numpy Array1
-        arr = in_band.ReadAsArray()
+        # TerrSet binary rasters are memory-mapped, other formats are read through GDAL
+        arr = read_array(image)
         return arr
 
-    def nrt_calculation(self, in_fn, deforestation_hrp, mask):
+    @releases_datasets
+    def distance_from_forest_edge(self, fmask, out_fn, max_distance, workers=None, tile_size=EDT_TILE_SIZE):
         '''
-        NRT calculation
+        Map of distance from the forest edge
+        The forest mask is processed in tiles with a halo of max_distance across a process pool,
+        each worker only holds the distance transform of one tile.
+        :param fmask: mask of the forest areas (binary map)
+        :param out_fn: output distance map (map units, 0 in non-forest)
+        :param max_distance: distances are capped at max_distance (map units), should be larger than the NRT
+        :param workers: number of processes, all CPUs by default
+        :param tile_size: number of rows and columns per tile
+        '''
+        self.progress_updated.emit(0)
+        self.write_tiles(edge_distance_tile, fmask, out_fn, (fmask,), (max_distance,), workers, tile_size)
+        self.progress_updated.emit(100)
+
+    @releases_datasets
+    def update_distance_from_forest_edge(self, distance_fn, change_fn, out_fn, max_distance, workers=None,
+                                         tile_size=EDT_TILE_SIZE):
+        '''
+        Update a map of distance from the forest edge with new deforestation (e.g., from the CAL to the HRP)
+        Only the tiles within max_distance of the new deforestation are transformed again, the other tiles
+        are copied from the previous map. The result is the same as distance_from_forest_edge on the new
+        forest mask when the previous map was capped at max_distance or more.
+        :param distance_fn: previous map of distance from the forest edge
+        :param change_fn: binary map of the new deforestation (1 = forest lost since the previous map)
+        :param out_fn: output distance map (map units, 0 in non-forest)
+        :param max_distance: distances are capped at max_distance (map units), e.g. the NRT
+        :param workers: number of processes, all CPUs by default
+        :param tile_size: number of rows and columns per tile
+        '''
+        self.progress_updated.emit(0)
+        self.write_tiles(updated_edge_distance_tile, distance_fn, out_fn, (distance_fn, change_fn), (max_distance,),
+                         workers, tile_size)
+        self.progress_updated.emit(100)
+
+    def write_tiles(self, tile_function, in_fn, out_fn, images, args, workers=None, tile_size=EDT_TILE_SIZE):
+        '''
+        Run a tile function across a process pool and write the tiles as they are done
+        :param tile_function: module-level function tile_function(*images, window, *args) -> (window, array)
+        :param in_fn: datasource to copy projection and geotransform from
+        :param out_fn: output float32 map
+        :param images: input rasters passed to the tile function
+        :param args: other arguments passed to the tile function
+        :param workers: number of processes, all CPUs by default
+        :param tile_size: number of rows and columns per tile
+        '''
+        in_info = raster_info(in_fn)
+        windows = list(tile_windows(in_info.x_size, in_info.y_size, tile_size))
+        workers = workers or os.cpu_count()
+        # Without a Python interpreter to spawn, the tiles are computed in this process
+        if python_executable() is None:
+            workers = 1
+
+        self.progress_updated.emit(10)
+        with RasterWriter(in_fn, out_fn, gdal.GDT_Float32, profile=self.write_profile) as writer:
+            if workers == 1:
+                for n_done, window in enumerate(windows, 1):
+                    writer.write(*tile_function(*images, window, *args))
+                    self.progress_updated.emit(10 + 80 * n_done // len(windows))
+            else:
+                with process_pool(workers) as pool:
+                    # Bound the number of tiles held in memory, tiles are written as soon as they are done
+                    max_pending = 2 * workers
+                    pending = set()
+                    n_done = 0
+                    for window in windows:
+                        pending.add(pool.submit(tile_function, *images, window, *args))
+                        if len(pending) >= max_pending:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                writer.write(*future.result())
+                                n_done += 1
+                            self.progress_updated.emit(10 + 80 * n_done // len(windows))
+                    for future in pending:
+                        writer.write(*future.result())
+                        n_done += 1
+                        self.progress_updated.emit(10 + 80 * n_done // len(windows))
+
+    def distance_histogram(self, in_fn, deforestation_hrp, mask):
+        '''
+        Exact histogram of the distance from the forest edge within the deforestation pixels and study area
         :param in_fn: map of distance from the forest eddge in CAL
         :param deforestation_hrp:deforestation binary map in HRP
         :param mask: mask of the non-excluded jurisdiction (binary map)
-        :return: NRT: Negligible Risk Threshold
+        :return: values: sorted non-zero distances, counts: number of pixels at each distance
         '''
-        # Convert image to NumPy array
-        self.progress_updated.emit(10)
-        distance_arr_cal = self.image_to_array(in_fn)
-        self.progress_updated.emit(30)
-        deforestation_hrp_arr = self.image_to_array(deforestation_hrp)
-        self.progress_updated.emit(40)
-        mask_arr = self.image_to_array(mask)
-        self.progress_updated.emit(50)
-
-        # Mask the distance arr within deforstation pixel and study area
-        distance_arr_masked=distance_arr_cal*mask_arr*deforestation_hrp_arr
-        self.progress_updated.emit(60)
-
-        ## Calculate the histogram
-        # Flatten the distance_arr_masked and expect 0 for np.histogram function
-        # The np.histogram is computed over the flattened array
-        distance_arr_masked_1d = distance_arr_masked.flatten()
-        self.progress_updated.emit(80)
-        distance_arr_masked_1d = distance_arr_masked_1d[distance_arr_masked_1d != 0]
+        # Integer distances are counted with np.bincount, other distances with np.unique per block,
+        # memory depends on the number of distinct distances and not on the size of the map
+        bincounts = np.zeros(0, dtype=np.int64)
+        values = np.zeros(0, dtype=np.float64)
+        counts = np.zeros(0, dtype=np.int64)
+        distance_dtype = np.float64
+        for _, (distance_arr_cal, deforestation_hrp_arr, mask_arr) in iter_blocks(in_fn, deforestation_hrp, mask):
+            distance_arr_masked = distance_arr_cal * mask_arr * deforestation_hrp_arr
+            distance_arr_masked_1d = distance_arr_masked[distance_arr_masked != 0]
+            if distance_arr_masked_1d.size == 0:
+                continue
+            distance_dtype = distance_arr_masked_1d.dtype
+            if distance_arr_masked_1d.dtype.kind in 'iu' and distance_arr_masked_1d.min() >= 0:
+                block_counts = np.bincount(distance_arr_masked_1d)
+                if block_counts.size > bincounts.size:
+                    block_counts[:bincounts.size] += bincounts
+                    bincounts = block_counts
+                else:
+                    bincounts[:block_counts.size] += block_counts
+            else:
+                block_values, block_counts = np.unique(distance_arr_masked_1d, return_counts=True)
+                values, counts = self.merge_counts(np.concatenate((values, block_values)),
+                                                   np.concatenate((counts, block_counts)))
+
+        # Merge the integer distances with the other distances, the values keep the data type of the masked distance
+        int_values = np.flatnonzero(bincounts)
+        values, counts = self.merge_counts(np.concatenate((values, int_values)),
+                                           np.concatenate((counts, bincounts[int_values])))
+        return values.astype(distance_dtype), counts
+
+    def cached_distance_histogram(self, in_fn, deforestation_hrp, mask):
+        '''
+        Distance histogram of the NRT calculation, computed once as long as the input files do not change
+        :param in_fn: map of distance from the forest eddge in CAL
+        :param deforestation_hrp:deforestation binary map in HRP
+        :param mask: mask of the non-excluded jurisdiction (binary map)
+        :return: values: sorted non-zero distances, counts: number of pixels at each distance
+        '''
+        key = tuple(file_key(image) for image in (in_fn, deforestation_hrp, mask))
+        if None in key:
+            return self.distance_histogram(in_fn, deforestation_hrp, mask)
+        if key not in self.distance_histograms:
+            # Drop the histograms of previous versions of the same files
+            for stale_key in [k for k in self.distance_histograms if [f[0] for f in k] == [f[0] for f in key]]:
+                del self.distance_histograms[stale_key]
+            self.distance_histograms[key] = self.distance_histogram(in_fn, deforestation_hrp, mask)
+        return self.distance_histograms[key]
+
+    def merge_counts(self, values, counts):
+        '''
+        Sum the counts of the same values
+        :param values: values, may be repeated
+        :param counts: count of each value
+        :return: values: sorted unique values, counts: total count of each value
+        '''
+        unique_values, inverse = np.unique(values, return_inverse=True)
+        unique_counts = np.bincount(inverse.ravel(), weights=counts, minlength=unique_values.size).astype(np.int64)
+        return unique_values, unique_counts
 
-        ## Calculate the histogram
-        # Set up bin width as spatial resolution
-        in_ds = gdal.Open(in_fn)
-        P = in_ds.GetGeoTransform()[1]
-        bin_width =int(P)
+    def nrt_from_histogram(self, values, counts, bin_width, percentile=NRT_PERCENTILE):
+        '''
+        NRT from the histogram of the distance from the forest edge
+        :param values: sorted non-zero distances
+        :param counts: number of pixels at each distance
+        :param bin_width: bin width of the histogram
+        :param percentile: cumulative proportion of the deforestation within the NRT
+        :return: NRT: Negligible Risk Threshold
+        '''
         # Calculate the histogram
-        hist, bin_edges = np.histogram(distance_arr_masked_1d, bins=np.arange(distance_arr_masked_1d.min(),
-                                                                              distance_arr_masked_1d.max() + bin_width,
-                                                                               bin_width))
+        hist, bin_edges = np.histogram(values, bins=np.arange(values.min(), values.max() + bin_width, bin_width),
+                                       weights=counts)
         # Calculate the cumulative proportion
         # Normalize the histogram to get probability
         hist_normalized = hist / np.sum(hist)
@@ -76,194 +275,310 @@ class VulnerabilityMap(QObject):
         # Compute cumulative distribution
         cumulative_prop = np.cumsum(hist_normalized)
 
-        # # Find the index cumulative proportion >= 0.995
-        index_995 = np.argmax(cumulative_prop >= 0.995)
+        # # Find the index cumulative proportion >= percentile
+        index_nrt = np.argmax(cumulative_prop >= percentile)
 
         # Get the bin edges for the NRT bin
-        nrt_bin_start = bin_edges[index_995]
-        nrt_bin_end = bin_edges[index_995 + 1]
-        self.progress_updated.emit(90)
+        nrt_bin_start = bin_edges[index_nrt]
+        nrt_bin_end = bin_edges[index_nrt + 1]
 
         # Calculate the average of the NRT bin
         NRT = int((nrt_bin_start + nrt_bin_end) / 2)
-        self.progress_updated.emit(100)
         return NRT
 
-    def geometric_classification(self, in_fn, NRT, n_classes):
+    @releases_datasets
+    def nrt_calculation(self, in_fn, deforestation_hrp, mask):
         '''
-        geometric classification
-        :param in_fn: map of distance from the forest eddge
-        :param NRT:Negligible Risk Threshold
-        :param n_classes:number of classes
-        :return: mask_arr: result array with mask larger than NRT
+        NRT calculation
+        :param in_fn: map of distance from the forest eddge in CAL
+        :param deforestation_hrp:deforestation binary map in HRP
+        :param mask: mask of the non-excluded jurisdiction (binary map)
+        :return: NRT: Negligible Risk Threshold
         '''
-        # Convert in_fn to NumPy array
-        # Set up a GDAL dataset
-        in_ds = gdal.Open(in_fn)
-        # Set up a GDAL band
-        in_band = in_ds.GetRasterBand(1)
-        # Create Numpy Array
-        arr = in_band.ReadAsArray()
+        self.progress_updated.emit(10)
+        # Count the distance within deforstation pixel and study area block by block, expect 0
+        values, counts = self.cached_distance_histogram(in_fn, deforestation_hrp, mask)
+        self.progress_updated.emit(80)
 
-        # The lower limit of the highest class = spatial resolution (the minimum distance possible without being in non-forest)
-        LL = int(in_ds.GetGeoTransform()[1])
+        ## Calculate the histogram
+        # Set up bin width as spatial resolution
+        P = raster_info(in_fn).geotransform[1]
+        bin_width =int(P)
+        NRT = self.nrt_from_histogram(values, counts, bin_width)
+        self.progress_updated.emit(100)
+        return NRT
 
+    @releases_datasets
+    def nrt_sweep(self, in_fn, deforestation_hrp, mask, percentiles, bin_multiples=(1,)):
+        '''
+        NRT for several cumulative proportions and bin widths, the distance histogram is computed once
+        :param in_fn: map of distance from the forest eddge in CAL
+        :param deforestation_hrp:deforestation binary map in HRP
+        :param mask: mask of the non-excluded jurisdiction (binary map)
+        :param percentiles: list of cumulative proportions (e.g., [0.99, 0.995, 0.999])
+        :param bin_multiples: list of bin widths as multiples of the spatial resolution
+        :return: nrt_table: dictionary {(percentile, bin_multiple): NRT}
+        '''
         self.progress_updated.emit(10)
-        # The upper limit of the lowest class = the Negligible Risk Threshold
-        UL = NRT = int(NRT)
-        n_classes = int(n_classes)
+        values, counts = self.cached_distance_histogram(in_fn, deforestation_hrp, mask)
+        self.progress_updated.emit(80)
 
+        P = raster_info(in_fn).geotransform[1]
+        nrt_table = {}
+        for bin_multiple in bin_multiples:
+            bin_width = int(P) * bin_multiple
+            for percentile in percentiles:
+                nrt_table[(percentile, bin_multiple)] = self.nrt_from_histogram(values, counts, bin_width, percentile)
+        self.progress_updated.emit(100)
+        return nrt_table
+
+    def geometric_lower_limits(self, LL, UL, n_classes):
+        '''
+        Lower limits of the geometric classes between LL and UL
+        :param LL: lower limit of the highest class
+        :param UL: upper limit of the lowest class
+        :param n_classes: number of classes
+        :return: array of n_classes lower limits in increasing order, UL*r^n_classes (= LL) ... UL*r
+        '''
         # Calculate common ratio(r)=(LLmax/LLmin)^1/n_classes
-        r = np.power(LL / UL, 1/n_classes)
+        r = np.power(LL / UL, 1 / n_classes)
 
-        # Create 2D class_array for the areas within the NRT
-        class_array = np.array([[i, i + 1] for i in range(n_classes)])
+        # Calculate LL value of each class, the UL of a class is the LL of the next one
+        x = np.power(r, np.arange(n_classes, 0, -1))
+        return np.multiply(UL, x)
 
-        # Calculate UL and LL value for the areas within the NRT
-        x= np.power(r, class_array)
-        risk_class=np.multiply(UL,x)
+    def classify_distance(self, arr, NRT, n_classes, LL):
+        '''
+        Geometric classification of a distance array in a single pass
+        :param arr: distance from the forest edge
+        :param NRT: Negligible Risk Threshold
+        :param n_classes: number of classes within the NRT
+        :param LL: lower limit of the highest class (spatial resolution)
+        :return: class_arr: 1 beyond the NRT, 2 to n_classes + 1 from the NRT to LL, 0 outside the forest
+        '''
+        UL = int(NRT)
+        n_classes = int(n_classes)
+        lower_limits = self.geometric_lower_limits(LL, UL, n_classes)
+        _, class_dtype = minimal_integer_type(0, n_classes + 1)
+
+        # Number of lower limits <= distance: n_classes in the class next to the NRT (class 2)
+        # down to 1 in the class next to the forest edge (class n_classes + 1)
+        # Distances below LL are not possible in forest and fall in the highest class
+        index = np.searchsorted(lower_limits, arr, side='right')
+        class_arr = (n_classes + 2 - np.maximum(index, 1)).astype(class_dtype)
 
-        self.progress_updated.emit(20)
         # Create mask: areas beyond the NRT, assign class 1
-        mask_arr=arr
-        mask_arr[arr >= NRT] = 1
-
-        self.progress_updated.emit(30)
-        # Use boolean indexing to reclassification mask_arr value >= LL into risk_class
-        # (e.g., if n_class is 29, class the areas within the NRT into class 2 to 30)
-        # Set the progress_updated.emit() outside the loop to fasten the process
-        mask_arr[(risk_class[0][0] > mask_arr) & (mask_arr >= risk_class[0][1])] = 2
-        mask_arr[(risk_class[1][0] > mask_arr) & (mask_arr >= risk_class[1][1])] = 3
-        mask_arr[(risk_class[2][0] > mask_arr) & (mask_arr >= risk_class[2][1])] = 4
-        mask_arr[(risk_class[3][0] > mask_arr) & (mask_arr >= risk_class[3][1])] = 5
-        mask_arr[(risk_class[4][0] > mask_arr) & (mask_arr >= risk_class[4][1])] = 6
-        self.progress_updated.emit(40)
-        mask_arr[(risk_class[5][0] > mask_arr) & (mask_arr >= risk_class[5][1])] = 7
-        mask_arr[(risk_class[6][0] > mask_arr) & (mask_arr >= risk_class[6][1])] = 8
-        mask_arr[(risk_class[7][0] > mask_arr) & (mask_arr >= risk_class[7][1])] = 9
-        mask_arr[(risk_class[8][0] > mask_arr) & (mask_arr >= risk_class[8][1])] = 10
-        mask_arr[(risk_class[9][0] > mask_arr) & (mask_arr >= risk_class[9][1])] = 11
-        self.progress_updated.emit(50)
-        mask_arr[(risk_class[10][0] > mask_arr) & (mask_arr >= risk_class[10][1])] = 12
-        mask_arr[(risk_class[11][0] > mask_arr) & (mask_arr >= risk_class[11][1])] = 13
-        mask_arr[(risk_class[12][0] > mask_arr) & (mask_arr >= risk_class[12][1])] = 14
-        mask_arr[(risk_class[13][0] > mask_arr) & (mask_arr >= risk_class[13][1])] = 15
-        mask_arr[(risk_class[14][0] > mask_arr) & (mask_arr >= risk_class[14][1])] = 16
-        self.progress_updated.emit(60)
-        mask_arr[(risk_class[15][0] > mask_arr) & (mask_arr >= risk_class[15][1])] = 17
-        mask_arr[(risk_class[16][0] > mask_arr) & (mask_arr >= risk_class[16][1])] = 18
-        mask_arr[(risk_class[17][0] > mask_arr) & (mask_arr >= risk_class[17][1])] = 19
-        mask_arr[(risk_class[18][0] > mask_arr) & (mask_arr >= risk_class[18][1])] = 20
-        mask_arr[(risk_class[19][0] > mask_arr) & (mask_arr >= risk_class[19][1])] = 21
-        self.progress_updated.emit(70)
-        mask_arr[(risk_class[20][0] > mask_arr) & (mask_arr >= risk_class[20][1])] = 22
-        mask_arr[(risk_class[21][0] > mask_arr) & (mask_arr >= risk_class[21][1])] = 23
-        mask_arr[(risk_class[22][0] > mask_arr) & (mask_arr >= risk_class[22][1])] = 24
-        mask_arr[(risk_class[23][0] > mask_arr) & (mask_arr >= risk_class[23][1])] = 25
-        mask_arr[(risk_class[24][0] > mask_arr) & (mask_arr >= risk_class[24][1])] = 26
-        self.progress_updated.emit(80)
-        mask_arr[(risk_class[25][0] > mask_arr) & (mask_arr >= risk_class[25][1])] = 27
-        mask_arr[(risk_class[26][0] > mask_arr) & (mask_arr >= risk_class[26][1])] = 28
-        mask_arr[(risk_class[27][0] > mask_arr) & (mask_arr >= risk_class[27][1])] = 29
-        mask_arr[(risk_class[28][0] > mask_arr) & (mask_arr >= risk_class[28][1])] = 30
-        self.progress_updated.emit(90)
-        return mask_arr
+        class_arr[arr >= UL] = 1
+        # Non-forest (distance 0), negative and NaN values are outside the classification
+        class_arr[~(arr > 0)] = 0
+        return class_arr
+
+    def classify_vulnerability(self, arr_rescale, n_classes):
+        '''
+        Geometric classification of a rescaled empirical vulnerability array in a single pass
+        :param arr_rescale: vulnerability rescaled to [1.0, 2.0], 0 outside the jurisdiction and forest
+        :param n_classes: number of classes
+        :return: class_arr: 1 (lowest vulnerability) to n_classes (highest), 0 outside the jurisdiction and forest
+        '''
+        n_classes = int(n_classes)
+        # The lower limit of the highest class = 1, the upper limit of the lowest class = 2
+        lower_limits = self.geometric_lower_limits(int(1), int(2), n_classes)
+        _, class_dtype = minimal_integer_type(0, n_classes)
+
+        # Number of lower limits <= value is the class, the maximum (2.0) belongs to the highest class
+        # and values at 1.0 to the lowest class even if the limit is rounded above 1.0
+        index = np.searchsorted(lower_limits, arr_rescale, side='right')
+        class_arr = np.maximum(index, 1).astype(class_dtype)
+        class_arr[~(arr_rescale > 0)] = 0
+        return class_arr
+
+    def vulnerability_maximum(self, in_fn):
+        '''
+        Maximum of the empirical vulnerability map, from the band statistics when available,
+        otherwise from a block by block scan of the valid pixels
+        :param in_fn: Empirical vulnerability map
+        :return: max_value
+        '''
+        in_band = open_dataset(in_fn).GetRasterBand(1)
+        max_value = in_band.GetMaximum()
+        if max_value is not None:
+            return max_value
+
+        nodata = in_band.GetNoDataValue()
+        max_value = None
+        for _, (arr,) in iter_blocks(in_fn):
+            valid = ~np.isnan(arr) if arr.dtype.kind == 'f' else np.ones(arr.shape, dtype=bool)
+            if nodata is not None:
+                valid &= arr != nodata
+            if valid.any():
+                block_max = arr[valid].max()
+                max_value = block_max if max_value is None else max(max_value, block_max)
+        if max_value is None:
+            raise ValueError(f"{in_fn} does not have any valid pixel")
+        return float(max_value)
+
+    def classify_alternative_block(self, arr, mask_block, fmask_block, max_value, n_classes):
+        '''
+        Rescale, mask and classify one block of the empirical vulnerability map
+        :param arr: block of the empirical vulnerability map
+        :param mask_block: block of the mask of the non-excluded jurisdiction
+        :param fmask_block: block of the mask of the forest areas
+        :param max_value: maximum of the empirical vulnerability map
+        :param n_classes: number of classes
+        :return: class_arr: 1 (lowest vulnerability) to n_classes (highest), 0 outside the jurisdiction and forest
+        '''
+        # Rescaled empirical vulnerability map to a [1.0–2.0] range, with the same expression and NumPy type
+        # promotion as a whole-map rescale (float64 unless the map is float32), so the classes do not change
+        arr_rescale = 1 + arr * 1 / max_value
+        class_arr = self.classify_vulnerability(arr_rescale, n_classes)
 
-    def geometric_classification_alternative(self, in_fn, n_classes, mask, fmask):
+        # Mask jurisdiction and forest area
+        class_arr[(mask_block == 0) | (fmask_block == 0)] = 0
+        return class_arr
+
+    def quantile_sketch_block(self, arr, mask_block, fmask_block, max_value, refine_bins=None):
+        '''
+        Histogram sketch of one block of the empirical vulnerability map within the jurisdiction and forest area
+        Sketches of different blocks are merged by adding them.
+        :param arr: block of the empirical vulnerability map
+        :param mask_block: block of the mask of the non-excluded jurisdiction
+        :param fmask_block: block of the mask of the forest areas
+        :param max_value: maximum of the empirical vulnerability map
+        :param refine_bins: sorted bins of the first sketch to split again, None for the first sketch
+        :return: pixel counts of QUANTILE_SKETCH_BINS equal bins from 0 to max_value,
+                 or of QUANTILE_SKETCH_BINS sub-bins for each of the refine_bins
+        '''
+        values = arr[(mask_block != 0) & (fmask_block != 0)].astype(np.float64)
+        values = values[~np.isnan(values)]
+        position = values * (QUANTILE_SKETCH_BINS / max_value)
+        coarse_bins = np.clip(np.floor(position), 0, QUANTILE_SKETCH_BINS - 1).astype(np.int64)
+        if refine_bins is None:
+            return np.bincount(coarse_bins, minlength=QUANTILE_SKETCH_BINS)
+
+        # Keep the values within the refined bins and split each of these bins again
+        rank = np.minimum(np.searchsorted(refine_bins, coarse_bins), len(refine_bins) - 1)
+        selected = refine_bins[rank] == coarse_bins
+        sub_bins = np.clip(((position[selected] - coarse_bins[selected]) * QUANTILE_SKETCH_BINS).astype(np.int64),
+                           0, QUANTILE_SKETCH_BINS - 1)
+        return np.bincount(rank[selected] * QUANTILE_SKETCH_BINS + sub_bins,
+                           minlength=len(refine_bins) * QUANTILE_SKETCH_BINS)
+
+    def equal_area_breaks(self, in_fn, n_classes, mask, fmask):
         '''
-        geometric classification for alternative vulnerability map
+        Class breaks of the equal-area classification of an empirical vulnerability map
+        The breaks are quantiles of a two-level histogram sketch built block by block on the worker pool,
+        the forest pixels are never sorted.
         :param in_fn: Empirical vulnerability map [0.0,1.0] range
         :param n_classes:number of classes
         :param mask: mask of the non-excluded jurisdiction (binary map)
         :param fmask: mask of the forest areas (binary map)
-        :return: mask_arr: result array with mask larger than NRT
+        :return: breaks: n_classes - 1 increasing values, class k starts at breaks[k - 2]
         '''
-        # Convert in_fn to NumPy array
-        # Set up a GDAL dataset
-        in_ds = gdal.Open(in_fn)
-        # Set up a GDAL band
-        in_band = in_ds.GetRasterBand(1)
-        # Create Numpy Array
-        arr = in_band.ReadAsArray()
-
+        max_value = self.vulnerability_maximum(in_fn)
+
+        def sketch(refine_bins=None):
+            blocks = map_blocks(lambda arr, mask_block, fmask_block:
+                                self.quantile_sketch_block(arr, mask_block, fmask_block, max_value, refine_bins),
+                                iter_blocks(in_fn, mask, fmask), self.workers)
+            counts = None
+            for _, block_counts in blocks:
+                counts = block_counts if counts is None else counts + block_counts
+            return counts
+
+        # Bin where the cumulative count reaches k / n_classes of the pixels
+        cumulative_counts = np.cumsum(sketch())
+        targets = cumulative_counts[-1] * np.arange(1, int(n_classes)) / int(n_classes)
+        break_bins = np.searchsorted(cumulative_counts, targets)
+
+        # Split these bins again to place the breaks within the bins
+        refine_bins = np.unique(break_bins)
+        sub_counts = sketch(refine_bins).reshape(len(refine_bins), QUANTILE_SKETCH_BINS)
+        breaks = np.empty(len(targets), dtype=np.float64)
+        for k, (target, break_bin) in enumerate(zip(targets, break_bins)):
+            counts_before = cumulative_counts[break_bin - 1] if break_bin > 0 else 0
+            cumulative_sub_counts = counts_before + np.cumsum(sub_counts[np.searchsorted(refine_bins, break_bin)])
+            sub_bin = min(np.searchsorted(cumulative_sub_counts, target), QUANTILE_SKETCH_BINS - 1)
+            # A class starts at the upper edge of the sub-bin
+            breaks[k] = (break_bin + (sub_bin + 1) / QUANTILE_SKETCH_BINS) * (max_value / QUANTILE_SKETCH_BINS)
+        return breaks
+
+    def classify_equal_area_block(self, arr, mask_block, fmask_block, breaks):
+        '''
+        Equal-area classification of one block of the empirical vulnerability map
+        :param arr: block of the empirical vulnerability map
+        :param mask_block: block of the mask of the non-excluded jurisdiction
+        :param fmask_block: block of the mask of the forest areas
+        :param breaks: class breaks from equal_area_breaks
+        :return: class_arr: 1 (lowest vulnerability) to n_classes (highest), 0 outside the jurisdiction and forest
+        '''
+        _, class_dtype = minimal_integer_type(0, len(breaks) + 1)
+        class_arr = (np.searchsorted(breaks, arr, side='right') + 1).astype(class_dtype)
+        class_arr[(mask_block == 0) | (fmask_block == 0)] = 0
+        if arr.dtype.kind == 'f':
+            class_arr[np.isnan(arr)] = 0
+        return class_arr
+
+    @releases_datasets
+    def classify_batch(self, jobs, mask=None, fmask=None, method='geometric'):
+        '''
+        Classification of several vulnerability maps in one pass, written to disk block by block
+        The inputs, the mask and the forest mask are read once per block, the blocks are classified
+        on the worker pool and every output is written as its blocks are done.
+        :param jobs: list of (in_fn, NRT, n_classes, out_fn), in_fn is a map of distance from the forest edge
+                     or, with NRT None, an empirical vulnerability map [0.0,1.0] range
+        :param mask: mask of the non-excluded jurisdiction (binary map), required by the empirical maps
+        :param fmask: mask of the forest areas (binary map), required by the empirical maps
+        :param method: classification of the empirical maps, one of CLASSIFICATION_METHODS
+        '''
+        self.progress_updated.emit(0)
+        alternative = any(NRT is None for _, NRT, _, _ in jobs)
+        if alternative and (mask is None or fmask is None):
+            raise ValueError("The mask and the forest mask are required to classify an empirical vulnerability map")
+        if method not in CLASSIFICATION_METHODS:
+            raise ValueError(f"Unknown classification method: {method}")
+
+        # Each input is read once even if it is used by several jobs, the masks come last
+        images = list(dict.fromkeys(in_fn for in_fn, _, _, _ in jobs))
+        image_index = {image: i for i, image in enumerate(images)}
+        if alternative:
+            images += [mask, fmask]
+
+        # The lower limit of the highest class = spatial resolution for the distance maps, the maximum
+        # for the empirical vulnerability maps, or the class breaks of the equal-area classification
+        limits = []
+        for in_fn, NRT, n_classes, _ in jobs:
+            if NRT is not None:
+                limits.append(int(raster_info(in_fn).geotransform[1]))
+            elif method == 'equal_area':
+                limits.append(self.equal_area_breaks(in_fn, n_classes, mask, fmask))
+            else:
+                limits.append(self.vulnerability_maximum(in_fn))
         self.progress_updated.emit(10)
-        max_value = in_band.GetMaximum()
 
-        # Rescaled empirical vulnerability map to a [1.0–2.0] range
-        arr_rescale = 1+arr*1/max_value
-
-        # The lower limit of the highest class = 1
-        LL = int(1)
-
-        # The upper limit of the lowest class = 2
-        UL = int(2)
-        n_classes = int(n_classes)
-
-        # Calculate common ratio(r)=(LLmax/LLmin)^1/n_classes
-        r = np.power(LL / UL, 1 / n_classes)
-
-        # Create 2D class_array for the areas within the NRT
-        class_array = np.array([[i, i + 1] for i in range(n_classes-1, -1, -1)])
-
-        # Calculate UL and LL value for the areas within the NRT
-        x = np.power(r, class_array)
-        risk_class = np.multiply(UL, x)
-
-        self.progress_updated.emit(20)
-
-        # Mask jurisdiction and forest area
-        # Create jurisdiction mask array
-        in_ds1 = gdal.Open(mask)
-        in_band1 = in_ds1.GetRasterBand(1)
-        mask_arr = in_band1.ReadAsArray()
-        # Create forest area array
-        in_ds2 = gdal.Open(fmask)
-        in_band2 = in_ds2.GetRasterBand(1)
-        fmask_arr = in_band2.ReadAsArray()
-        # Array multiple mask and fmask
-        mask_arr = arr_rescale*mask_arr*fmask_arr
-
-        self.progress_updated.emit(30)
-        # Use boolean indexing to reclassification mask_arr value >= LL into risk_class
-        # (e.g., if n_class is 29, class the areas within the NRT into class 2 to 30)
-        # Set the progress_updated.emit() outside the loop to fasten the process
-        mask_arr[(risk_class[0][0] > mask_arr) & (mask_arr >= risk_class[0][1])] = 1
-        mask_arr[(risk_class[1][0] > mask_arr) & (mask_arr >= risk_class[1][1])] = 2
-        mask_arr[(risk_class[2][0] > mask_arr) & (mask_arr >= risk_class[2][1])] = 3
-        mask_arr[(risk_class[3][0] > mask_arr) & (mask_arr >= risk_class[3][1])] = 4
-        mask_arr[(risk_class[4][0] > mask_arr) & (mask_arr >= risk_class[4][1])] = 5
-        self.progress_updated.emit(40)
-        mask_arr[(risk_class[5][0] > mask_arr) & (mask_arr >= risk_class[5][1])] = 6
-        mask_arr[(risk_class[6][0] > mask_arr) & (mask_arr >= risk_class[6][1])] = 7
-        mask_arr[(risk_class[7][0] > mask_arr) & (mask_arr >= risk_class[7][1])] = 8
-        mask_arr[(risk_class[8][0] > mask_arr) & (mask_arr >= risk_class[8][1])] = 9
-        mask_arr[(risk_class[9][0] > mask_arr) & (mask_arr >= risk_class[9][1])] = 10
-        self.progress_updated.emit(50)
-        mask_arr[(risk_class[10][0] > mask_arr) & (mask_arr >= risk_class[10][1])] = 11
-        mask_arr[(risk_class[11][0] > mask_arr) & (mask_arr >= risk_class[11][1])] = 12
-        mask_arr[(risk_class[12][0] > mask_arr) & (mask_arr >= risk_class[12][1])] = 13
-        mask_arr[(risk_class[13][0] > mask_arr) & (mask_arr >= risk_class[13][1])] = 14
-        mask_arr[(risk_class[14][0] > mask_arr) & (mask_arr >= risk_class[14][1])] = 15
-        self.progress_updated.emit(60)
-        mask_arr[(risk_class[15][0] > mask_arr) & (mask_arr >= risk_class[15][1])] = 16
-        mask_arr[(risk_class[16][0] > mask_arr) & (mask_arr >= risk_class[16][1])] = 17
-        mask_arr[(risk_class[17][0] > mask_arr) & (mask_arr >= risk_class[17][1])] = 18
-        mask_arr[(risk_class[18][0] > mask_arr) & (mask_arr >= risk_class[18][1])] = 19
-        mask_arr[(risk_class[19][0] > mask_arr) & (mask_arr >= risk_class[19][1])] = 20
-        self.progress_updated.emit(70)
-        mask_arr[(risk_class[20][0] > mask_arr) & (mask_arr >= risk_class[20][1])] = 21
-        mask_arr[(risk_class[21][0] > mask_arr) & (mask_arr >= risk_class[21][1])] = 22
-        mask_arr[(risk_class[22][0] > mask_arr) & (mask_arr >= risk_class[22][1])] = 23
-        mask_arr[(risk_class[23][0] > mask_arr) & (mask_arr >= risk_class[23][1])] = 24
-        mask_arr[(risk_class[24][0] > mask_arr) & (mask_arr >= risk_class[24][1])] = 25
-        self.progress_updated.emit(80)
-        mask_arr[(risk_class[25][0] > mask_arr) & (mask_arr >= risk_class[25][1])] = 26
-        mask_arr[(risk_class[26][0] > mask_arr) & (mask_arr >= risk_class[26][1])] = 27
-        mask_arr[(risk_class[27][0] > mask_arr) & (mask_arr >= risk_class[27][1])] = 28
-        mask_arr[(risk_class[28][0] > mask_arr) & (mask_arr >= risk_class[28][1])] = 29
-        mask_arr[(risk_class[29][0] > mask_arr) & (mask_arr >= risk_class[29][1])] = 30
-        self.progress_updated.emit(90)
-        return mask_arr
+        def classify_block(*arrays):
+            class_blocks = []
+            for (in_fn, NRT, n_classes, _), limit in zip(jobs, limits):
+                arr = arrays[image_index[in_fn]]
+                if NRT is not None:
+                    class_blocks.append(self.classify_distance(arr, NRT, n_classes, limit))
+                elif method == 'equal_area':
+                    class_blocks.append(self.classify_equal_area_block(arr, arrays[-2], arrays[-1], limit))
+                else:
+                    class_blocks.append(self.classify_alternative_block(arr, arrays[-2], arrays[-1], limit, n_classes))
+            return class_blocks
+
+        y_size = raster_info(images[0]).y_size
+        with ExitStack() as stack:
+            # Classes run from 1 to n_classes + 1 for the benchmark (class 1 beyond the NRT), stored in the smallest
+            # integer type holding all classes
+            writers = [stack.enter_context(RasterWriter(in_fn, out_fn, minimal_integer_type(0, int(n_classes) + 1)[0],
+                                                        profile=self.write_profile))
+                       for in_fn, _, n_classes, out_fn in jobs]
+            for window, class_blocks in map_blocks(classify_block, iter_blocks(*images), self.workers):
+                for writer, class_arr in zip(writers, class_blocks):
+                    writer.write(window, class_arr)
+                self.progress_updated.emit(10 + 80 * (window[1] + window[3]) // y_size)
+        self.progress_updated.emit(100)
 
     def array_to_image(self, in_fn, out_fn, data, data_type, nodata=None):
         '''
@@ -275,22 +590,9 @@ class VulnerabilityMap(QObject):
         :param nodata: optional NoData value
         :return:
         '''
-        in_ds = gdal.Open(in_fn)
-        output_format = out_fn.split('.')[-1].upper()
-        if (output_format == 'TIF'):
-            output_format = 'GTIFF'
-        elif (output_format == 'RST'):
-            output_format = 'rst'
-        driver = gdal.GetDriverByName(output_format)
-        out_ds = driver.Create(out_fn, in_ds.RasterXSize, in_ds.RasterYSize, 1, data_type, options=["BigTIFF=YES"])
-        out_ds.SetProjection(in_ds.GetProjection().encode('utf-8', 'backslashreplace').decode('utf-8'))
-        out_ds.SetGeoTransform(in_ds.GetGeoTransform())
-        out_band = out_ds.GetRasterBand(1)
-        if nodata is not None:
-            out_band.SetNoDataValue(nodata)
-        out_band.WriteArray(data)
-        out_band.FlushCache()
-        out_ds.FlushCache()
+        # Write the whole array as a single window
+        with RasterWriter(in_fn, out_fn, data_type, nodata, self.write_profile) as writer:
+            writer.write((0, 0, data.shape[1], data.shape[0]), data)
         return
 
     def replace_ref_system(self, in_fn, out_fn):
@@ -299,25 +601,5 @@ class VulnerabilityMap(QObject):
          :param in_fn: datasource to copy correct projection name
          :param out_fn: rst raster file
         '''
-        if out_fn.split('.')[-1] == 'rst':
-            read_file_name, _ = os.path.splitext(in_fn)
-            write_file_name, _ = os.path.splitext(out_fn)
-            temp_file_path = 'rdc_temp.rdc'
-
-            with open(read_file_name + '.rdc', 'r') as read_file:
-                for line in read_file:
-                    if line.startswith("ref. system :"):
-                        correct_name=line
-                        break
-
-            if correct_name:
-                with open(write_file_name + '.rdc', 'r') as read_file, open(temp_file_path, 'w') as write_file:
-                    for line in read_file:
-                        if line.startswith("ref. system :"):
-                            write_file.write(correct_name)
-                        else:
-                            write_file.write(line)
-
-                # Move the temp file to replace the original
-                shutil.move(temp_file_path, write_file_name + '.rdc')
-                self.progress_updated.emit(100)
\ No newline at end of file
+        if fix_ref_system(in_fn, out_fn):
+            self.progress_updated.emit(100)